@@ -4,6 +4,7 @@ from logging import debug
 from os import environ
 
 from flask import Flask
+from flask_compress import Compress
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
@@ -17,6 +18,16 @@ if "FLASK_ENV" in environ and environ["FLASK_ENV"] == "development":
 else:
     app = Flask(__name__, static_folder=None)
 
+# compress JSON and CSV responses, except streamed responses which are
+# compressed as they are generated (see fhodot.app.utils)
+app.config.update(
+    COMPRESS_MIMETYPES=["application/json", "application/x-ndjson",
+                        "text/csv"],
+    COMPRESS_ALGORITHM=["br", "gzip"],
+    COMPRESS_LEVEL=5,
+    COMPRESS_STREAMS=False)
+Compress(app)
+
 limiter = Limiter(app,
                   key_func=get_remote_address,
                   default_limits=["10 per second", "60 per minute"],
@@ -0,0 +1,92 @@
+"""Redis cache for Flask API responses
+
+Uses the same Redis server as Flask-Limiter.
+"""
+
+from functools import wraps
+from hashlib import sha1
+from logging import warning
+
+from flask import make_response, request
+from redis import Redis
+from redis.exceptions import RedisError
+
+from fhodot.config import REDIS_URL
+
+
+redis_client = Redis.from_url(REDIS_URL)
+
+
+def get_cache_key():
+    """Return Redis key for the current request's path and query"""
+    digest = sha1(request.full_path.encode("utf-8")).hexdigest()
+    return f"fhodot:response:{digest}"
+
+
+def cached_response(ttl=3600):
+    """Decorator to cache a view's successful responses in Redis
+
+    The response body and content type are cached for ttl seconds,
+    keyed by the request path and query string. If Redis is unavailable,
+    the view is called as normal. Successful responses also allow
+    browsers and proxies to cache them for ttl seconds.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = get_cache_key()
+            try:
+                cached = redis_client.hgetall(key)
+            except RedisError:
+                warning("Could not fetch response from Redis cache")
+                cached = None
+            if cached:
+                response = make_response(
+                    (cached[b"body"], 200,
+                     {"Content-Type": cached[b"content_type"].decode()}))
+                set_cache_control(response, ttl)
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                try:
+                    pipeline = redis_client.pipeline()
+                    pipeline.hset(key, mapping={
+                        "body": response.get_data(),
+                        "content_type": response.content_type})
+                    pipeline.expire(key, ttl)
+                    pipeline.execute()
+                except RedisError:
+                    warning("Could not store response in Redis cache")
+                set_cache_control(response, ttl)
+            return response
+        return wrapper
+
+    return decorator
+
+
+def cache_control(max_age):
+    """Decorator to allow browsers and proxies to cache a view's
+    successful responses for max_age seconds
+
+    Unlike cached_response, nothing is stored in Redis, so this can be
+    used for views with streamed responses.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                set_cache_control(response, max_age)
+            return response
+        return wrapper
+
+    return decorator
+
+
+def set_cache_control(response, max_age):
+    """Allow a response to be cached publicly for max_age seconds"""
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
@@ -1,27 +1,43 @@
 """Functions relating to FHRS endpoint for Flask API"""
 
+from operator import attrgetter
+
 from geoalchemy2.functions import ST_Intersects
 
-from fhodot.app.utils import get_envelope
+from fhodot.app.utils import get_envelope, get_mappings_options
 from fhodot.database import Session
 from fhodot.models import (FHRSAuthority, FHRSEstablishment,
                            LocalAuthorityDistrict)
 
 
+# (JSON property name, getter) pairs for an FHRS establishment returned
+# by the API, including its match counts
+SELECTED_FHRS_PROPERTIES = (
+    ("name", attrgetter("name")),
+    ("fhrsID", attrgetter("fhrs_id")),
+    ("postcode", attrgetter("postcode")),
+    ("postcodeOriginal", attrgetter("postcode_original")),
+    ("ratingDate", lambda establishment: str(establishment.rating_date)),
+    ("numMatchesSamePostcodes", attrgetter("num_matches_same_postcodes")),
+    ("numMatchesDifferentPostcodes",
+     attrgetter("num_matches_different_postcodes")))
+
+# properties of the OSM object in each of an establishment's mappings
+MAPPED_OSM_OBJECT_PROPERTIES = (
+    ("name", attrgetter("name")),
+    ("osmType", attrgetter("osm_type")),
+    ("osmIDByType", attrgetter("osm_id_by_type")),
+    ("postcode", attrgetter("addr_postcode")),
+    ("notPostcode", attrgetter("not_addr_postcode")))
+
+
 def get_selected_fhrs_properties(fhrs_establishment):
     """Get selected properties of an FHRS establishment"""
 
     assert isinstance(fhrs_establishment, FHRSEstablishment)
 
-    return {"name": fhrs_establishment.name,
-            "fhrsID": fhrs_establishment.fhrs_id,
-            "postcode": fhrs_establishment.postcode,
-            "postcodeOriginal": fhrs_establishment.postcode_original,
-            "ratingDate": str(fhrs_establishment.rating_date),
-            "numMatchesSamePostcodes":
-                fhrs_establishment.num_matches_same_postcodes,
-            "numMatchesDifferentPostcodes":
-                fhrs_establishment.num_matches_different_postcodes}
+    return {name: getter(fhrs_establishment)
+            for name, getter in SELECTED_FHRS_PROPERTIES}
 
 
 def get_osm_mappings(fhrs_establishment, include_distance=False):
@@ -34,18 +50,25 @@ def get_osm_mappings(fhrs_establishment, include_distance=False):
         result = {"postcodesMatch": mapping.postcodes_match}
         if include_distance:
             result["distance"] = mapping.distance
-        if mapping.osm_object:
-            result["osmObject"] = {
-                "name": mapping.osm_object.name,
-                "osmType": mapping.osm_object.osm_type,
-                "osmIDByType": mapping.osm_object.osm_id_by_type,
-                "postcode": mapping.osm_object.addr_postcode,
-                "notPostcode": mapping.osm_object.not_addr_postcode}
+        osm_object = mapping.osm_object
+        if osm_object:
+            result["osmObject"] = {name: getter(osm_object) for name, getter
+                                   in MAPPED_OSM_OBJECT_PROPERTIES}
         results.append(result)
 
     return results
 
 
+def get_osm_mappings_options(include_distance=False):
+    """Get loader options for an establishment's OSM mappings
+
+    Loads each mapping's OSM object for get_osm_mappings, and each
+    mapping's distance if include_distance is True.
+    """
+    return get_mappings_options(FHRSEstablishment.osm_mappings,
+                                include_distance)
+
+
 def query_fhrs_without_location_for_districts_in_bbox(bbox):
     """Query for establishments without location for districts in bbox
 
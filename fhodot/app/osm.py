@@ -1,29 +1,57 @@
 """Functions relating to OSM endpoint for Flask API"""
 
+from operator import attrgetter
+
+from fhodot.app.utils import get_mappings_options
 from fhodot.models import OSMObject
 
 
+def get_bad_fhrs_ids_string(osm_object):
+    """Get fhrs:id string if invalid, otherwise an empty string"""
+    if not osm_object.fhrs_ids_string_valid:
+        return osm_object.fhrs_ids_string
+    return ""
+
+
+# (JSON property name, getter) pairs for an OSM object returned by the
+# API, including any invalid fhrs:id tag and match/mismatch counts
+SELECTED_OSM_PROPERTIES = (
+    ("name", attrgetter("name")),
+    ("osmIDByType", attrgetter("osm_id_by_type")),
+    ("osmType", attrgetter("osm_type")),
+    ("postcode", attrgetter("addr_postcode")),
+    ("notPostcode", attrgetter("not_addr_postcode")),
+    ("badFHRSIDsString", get_bad_fhrs_ids_string),
+    ("numMatchesSamePostcodes", attrgetter("num_matches_same_postcodes")),
+    ("numMatchesDifferentPostcodes",
+     attrgetter("num_matches_different_postcodes")),
+    ("numMismatchedFHRSIDs", attrgetter("num_mismatched_fhrs_ids")))
+
+# properties of the FHRS establishment in each of an OSM object's
+# mappings
+MAPPED_FHRS_ESTABLISHMENT_PROPERTIES = (
+    ("name", attrgetter("name")),
+    ("postcode", attrgetter("postcode")),
+    ("postcodeOriginal", attrgetter("postcode_original")),
+    ("ratingDate", lambda establishment: str(establishment.rating_date)))
+
+
 def get_selected_osm_properties(osm_object):
     """Get selected properties of an OSM object"""
 
     assert isinstance(osm_object, OSMObject)
 
-    bad_fhrs_ids_string = ""
-    if not osm_object.fhrs_ids_string_valid:
-        bad_fhrs_ids_string = osm_object.fhrs_ids_string
-
-    return {"name": osm_object.name,
-            "osmIDByType": osm_object.osm_id_by_type,
-            "osmType": osm_object.osm_type,
-            "postcode": osm_object.addr_postcode,
-            "notPostcode": osm_object.not_addr_postcode,
-            "badFHRSIDsString": bad_fhrs_ids_string,
-            "numMatchesSamePostcodes":
-                osm_object.num_matches_same_postcodes,
-            "numMatchesDifferentPostcodes":
-                osm_object.num_matches_different_postcodes,
-            "numMismatchedFHRSIDs":
-                osm_object.num_mismatched_fhrs_ids}
+    return {name: getter(osm_object)
+            for name, getter in SELECTED_OSM_PROPERTIES}
+
+
+def get_fhrs_mappings_options(include_distance=False):
+    """Get loader options for an OSM object's FHRS mappings
+
+    Loads each mapping's FHRS establishment for get_fhrs_mappings, and
+    each mapping's distance if include_distance is True.
+    """
+    return get_mappings_options(OSMObject.fhrs_mappings, include_distance)
 
 
 def get_fhrs_mappings(osm_object, include_distance=False,
@@ -41,10 +69,8 @@ def get_fhrs_mappings(osm_object, include_distance=False,
         establishment = mapping.fhrs_establishment
         if establishment:
             result["fhrsEstablishment"] = {
-                "name": establishment.name,
-                "postcode": establishment.postcode,
-                "postcodeOriginal": establishment.postcode_original,
-                "ratingDate": str(establishment.rating_date)}
+                name: getter(establishment) for name, getter
+                in MAPPED_FHRS_ESTABLISHMENT_PROPERTIES}
             if include_location:
                 result["fhrsEstablishment"]["lat"] = (
                     establishment.lat)
@@ -19,9 +19,8 @@ Tokens that cannot be parsed or that would create duplicate tags are
 tagged with fixme:addr:*.
 """
 
-from itertools import chain, groupby
 from os.path import abspath, dirname, join
-from re import search
+from re import compile as re_compile
 
 from sqlalchemy import or_
 
@@ -35,9 +34,10 @@ module_dir = dirname(abspath(__file__))
 data_dir = join(module_dir, "parse_addresses_data")
 
 # load and standardise counties, ignoring empty/comment lines
+# (frozensets rather than lists for constant-time membership tests)
 with open(join(data_dir, "counties.txt"), "r") as file:
-    counties = [standardise(line) for line in file.read().splitlines()
-                if line.strip() and not line.startswith("#")]
+    counties = frozenset(standardise(line) for line in file.read().splitlines()
+                         if line.strip() and not line.startswith("#"))
 
 # load dict of standardised post towns by postcode area,
 # ignoring empty/comment lines
@@ -49,40 +49,62 @@ with open(join(data_dir, "post_towns.txt"), "r") as file:
             continue
         fields = line.split("\t")
         assert len(fields) == 2
-        post_towns_by_area[fields[0]] = [
-            standardise(town) for town in fields[1].split(",")]
+        post_towns_by_area[fields[0]] = frozenset(
+            standardise(town) for town in fields[1].split(","))
 
-# store generator output as list to allow using more than once
-all_post_towns = list(chain.from_iterable(post_towns_by_area.values()))
+all_post_towns = frozenset().union(*post_towns_by_area.values())
 
 NUM_RANGE_PATTERN = "[0-9]+[A-Za-z]?( *[-–] *[0-9]+[A-Za-z]?)?"
 
+# house number (range) at the start of a token and postcode area letters
+NUM_RANGE_START_REGEX = re_compile(f"^({NUM_RANGE_PATTERN})( +.*)?$")
+POSTCODE_AREA_REGEX = re_compile("^[A-Z]{1,2}")
+# common final words from OS Open Names roads in Great Britain (not
+# Northern Ireland), accounting for approx. 68% of roads
+ROAD_ENDING_REGEX = re_compile(
+    " (road|close|street|lane|avenue|drive|way)$")
+# floor and unit descriptions, e.g. "2nd floor", "units 1-3"
+FLOOR_ORDINAL_REGEX = re_compile("^([0-9]+)(st|nd|rd|th) +floor$")
+FLOOR_NUMBER_REGEX = re_compile("^floor +([0-9]+)$")
+FLOOR_WORD_REGEX = re_compile("^(ground|first|second) +floors?$")
+FLOOR_ENDING_REGEX = re_compile(" floor$")
+UNIT_OPENING_PATTERN = "^(unit|flat)s? +"
+UNIT_OPENING_REGEX = re_compile(UNIT_OPENING_PATTERN)
+UNIT_REGEX = re_compile(f"{UNIT_OPENING_PATTERN}({NUM_RANGE_PATTERN})$")
+
 
 def prepare_tokens(establishment):
-    """Prepare tokens from establishment address"""
+    """Prepare tokens from establishment address
 
-    if establishment.address_1 == establishment.name:
-        establishment.address_1 = None
+    Address lines are split by commas and stripped in a single pass,
+    skipping empty tokens and consecutive duplicates e.g. same post town
+    and county. The first line is skipped if it is the same as the
+    establishment's name.
+    """
 
-    tokens = [establishment.address_1, establishment.address_2,
-              establishment.address_3, establishment.address_4]
-    tokens = [token for token in tokens if token] # i.e. not empty
-    # further split by commas
-    tokens = chain.from_iterable([token.split(",") for token in tokens])
-    tokens = [token.strip() for token in tokens]
-    # remove any consecutive duplicates e.g. same post town & county
-    tokens = [group[0] for group in groupby(tokens)]
+    lines = [establishment.address_2, establishment.address_3,
+             establishment.address_4]
+    if establishment.address_1 != establishment.name:
+        lines.insert(0, establishment.address_1)
 
     token_dicts = []
-    for token in tokens:
-        token_dicts.extend(split_number_and_create_dicts(token))
+    previous = None
+    for line in lines:
+        if not line:
+            continue
+        for token in line.split(","):
+            token = token.strip()
+            if not token or token == previous:
+                continue
+            previous = token
+            token_dicts.extend(split_number_and_create_dicts(token))
     return token_dicts
 
 
 def split_number_and_create_dicts(token):
     """Return list of 1 or 2 dicts for token, with number/range split"""
 
-    match = search(f"^({NUM_RANGE_PATTERN})( +.*)?$", token)
+    match = NUM_RANGE_START_REGEX.search(token)
     if match: # number/range at start
         number_token = {"string": match.group(1), "tag": "number"}
         if match.lastindex == 3 and match.group(3).strip():
@@ -98,7 +120,7 @@ def get_postcode_area(establishment):
     """Extract postcode area to use for filtering"""
     if not establishment.postcode:
         return None
-    match = search("^[A-Z]{1,2}", establishment.postcode)
+    match = POSTCODE_AREA_REGEX.search(establishment.postcode)
     assert match # validator function should prevent invalid postcodes
     postcode_area = match.group(0)
     if postcode_area in post_towns_by_area.keys():
@@ -137,14 +159,45 @@ def get_os_object(string, model_class, postcode_area):
                             model_class.name_2_std.like(string))).first()
 
 
-def get_place_tag(string, postcode_area):
+def get_os_objects_by_name(strings, model_class, postcode_area):
+    """Get the first matching OS Open Names object for several strings
+
+    Uses a single query rather than one per string. Returns a dict with
+    standardised names as keys and OS Open Names objects as values.
+    Uses postcode area to narrow down search if possible.
+    """
+    strings = {standardise(string) for string in strings}
+    strings.discard("") # e.g. a number or number-range token
+    if not strings:
+        return {}
+
+    query = Session.query(model_class)
+    if postcode_area:
+        query = query.filter(model_class.postcode_area == postcode_area)
+    query = query.filter(or_(model_class.name_1_std.in_(strings),
+                             model_class.name_2_std.in_(strings)))
+
+    os_objects_by_name = {}
+    for os_object in query:
+        for name in (os_object.name_1_std, os_object.name_2_std):
+            if name in strings:
+                os_objects_by_name.setdefault(name, os_object)
+    return os_objects_by_name
+
+
+def get_place_tag(string, postcode_area, os_places_by_name=None):
     """Get place tag if string matches name of a place, otherwise False
 
     Uses postcode area to narrow down search if possible. N.B. OS Open
-    Names data doesn't cover Northern Ireland.
+    Names data doesn't cover Northern Ireland. If os_places_by_name (as
+    returned by get_os_objects_by_name) is supplied, looks up the place
+    in it instead of querying the database.
     """
 
-    os_place = get_os_object(string, OSPlace, postcode_area)
+    if os_places_by_name is None:
+        os_place = get_os_object(string, OSPlace, postcode_area)
+    else:
+        os_place = os_places_by_name.get(standardise(string))
     if not os_place:
         return False
 
@@ -159,23 +212,23 @@ def get_place_tag(string, postcode_area):
     return place_tag
 
 
-def is_road(string, postcode_area):
+def is_road(string, postcode_area, os_roads_by_name=None):
     """Check whether a string matches the name of a road
 
     Uses postcode area to narrow down search if possible. OS Open Names
     data doesn't cover Northern Ireland, so if postcode area is 'BT',
-    looks for common road-name endings instead.
+    looks for common road-name endings instead. If os_roads_by_name (as
+    returned by get_os_objects_by_name) is supplied, looks up the road
+    in it instead of querying the database.
     """
     if postcode_area == "BT": # i.e. Northern Ireland
-        # common final words from OS Open Names roads in Great Britain
-        # (not Northern Ireland), accounting for approx. 68% of roads
-        words = ["road", "close", "street", "lane", "avenue", "drive", "way"]
-        pattern = " (" + "|".join(words) + ")$"
-        if search(pattern, string.lower()):
+        if ROAD_ENDING_REGEX.search(string.lower()):
             return True
         return False
 
     # within Great Britain
+    if os_roads_by_name is not None:
+        return standardise(string) in os_roads_by_name
     if get_os_object(string, OSRoad, postcode_area):
         return True
     return False
@@ -188,25 +241,27 @@ def get_floor(string):
     return the string unchanged.
     """
 
-    if "floor" not in string.lower():
+    lower = string.lower()
+    if "floor" not in lower:
         return False
     string = string.strip()
+    lower = lower.strip()
 
-    match = search("^([0-9]+)(st|nd|rd|th) +floor$", string.lower())
+    match = FLOOR_ORDINAL_REGEX.search(lower)
     if match:
         return match.group(1)
 
-    match = search("^floor +([0-9]+)$", string.lower())
+    match = FLOOR_NUMBER_REGEX.search(lower)
     if match:
         return match.group(1)
 
-    match = search("^(ground|first|second) +floors?$", string.lower())
+    match = FLOOR_WORD_REGEX.search(lower)
     if match:
         num_equivalent = {"ground": "0", "first": "1", "second": "2"}
         return num_equivalent[match.group(1)]
 
     # failsafes in case string contains 'floor' but doesn't match above
-    if search(" floor$", string.lower()):
+    if FLOOR_ENDING_REGEX.search(lower):
         return string
     return False
 
@@ -214,12 +269,12 @@ def get_floor(string):
 def get_unit(string):
     """Return unit from string, or False if not recognised"""
 
-    opening_pattern = "^(unit|flat)s? +"
-    if not search(opening_pattern, string.lower()):
+    lower = string.lower()
+    if not UNIT_OPENING_REGEX.search(lower):
         return False
     string = string.strip()
 
-    match = search(f"{opening_pattern}({NUM_RANGE_PATTERN})$", string.lower())
+    match = UNIT_REGEX.search(lower.strip())
     if match:
         return match.group(2).upper()
 
@@ -246,15 +301,26 @@ def set_addr_tag_if_unique(token, tag, existing_tags, string=None):
 def classify_tokens(tokens, postcode_area): # pylint:disable=too-many-branches
     """Add tags to a list of token dicts to classify the tokens"""
 
-    tokens.reverse() # address in reverse order
-
-    for token in tokens:
+    # look up all candidate places and roads up front rather than
+    # querying the database for each token
+    strings = [token["string"] for token in tokens
+               if token["tag"] != "number"]
+    os_places_by_name = get_os_objects_by_name(strings, OSPlace,
+                                               postcode_area)
+    os_roads_by_name = None # not needed in Northern Ireland
+    if postcode_area != "BT":
+        os_roads_by_name = get_os_objects_by_name(strings, OSRoad,
+                                                  postcode_area)
+
+    # updated as tags are set rather than rebuilt for every token
+    existing_tags = {token["tag"] for token in tokens}
+
+    for token in reversed(tokens): # address in reverse order
         # skip any number tokens, which can't be a city, county or place
         if token["tag"] == "number":
             continue
 
         string = token["string"]
-        existing_tags = [token["tag"] for token in tokens]
 
         # There should be max 1 addr:city and addr:county. If token is
         # both county and post town (e.g. London), tag as addr:city.
@@ -267,11 +333,11 @@ def classify_tokens(tokens, postcode_area): # pylint:disable=too-many-branches
             token["tag"] = "addr:county"
         # there can be multiple tokens tagged as a place, but not same type
         else:
-            place_tag = get_place_tag(string, postcode_area) # (or False)
+            place_tag = get_place_tag( # (or False)
+                string, postcode_area, os_places_by_name)
             if place_tag and place_tag not in existing_tags:
                 token["tag"] = place_tag
-
-    tokens.reverse() # address back to normal order
+        existing_tags.add(token["tag"])
 
     for token in tokens:
         # stop classifying once we find a place, post town or county
@@ -279,7 +345,6 @@ def classify_tokens(tokens, postcode_area): # pylint:disable=too-many-branches
             break
 
         string = token["string"]
-        existing_tags = [token["tag"] for token in tokens]
 
         # There should be max 1 addr:floor, addr:unit, addr:housenumber,
         # addr:street and housename. N.B. if a token is recognised, it
@@ -298,10 +363,11 @@ def classify_tokens(tokens, postcode_area): # pylint:disable=too-many-branches
                 token["tag"] = None
             else:
                 token["tag"] = "addr:housenumber"
-        elif is_road(string, postcode_area):
+        elif is_road(string, postcode_area, os_roads_by_name):
             token = set_addr_tag_if_unique(token, "street", existing_tags)
         else:
             token = set_addr_tag_if_unique(token, "housename", existing_tags)
+        existing_tags.add(token["tag"])
 
     return tokens
 
@@ -1,28 +1,33 @@
 """Routes for Flask API"""
 
 from csv import writer
-from io import StringIO
-from itertools import groupby
+from io import BytesIO, TextIOWrapper
+from itertools import groupby, islice
 from logging import error
 
-from flask import abort, make_response, request
+from flask import abort, request
 from geoalchemy2.functions import ST_Intersects
-from geojson import dumps, Feature, FeatureCollection
-from sqlalchemy.orm import joinedload, undefer
+from orjson import dumps
+from sqlalchemy.orm import defer, joinedload, load_only, selectinload
 
 from fhodot.app import app, limiter
+from fhodot.app.cache import cache_control, cached_response
 from fhodot.app.fhrs import (get_selected_fhrs_properties, get_osm_mappings,
+                             get_osm_mappings_options,
                              query_fhrs_without_location_for_districts_in_bbox)
-from fhodot.app.osm import get_selected_osm_properties, get_fhrs_mappings
+from fhodot.app.osm import (get_selected_osm_properties, get_fhrs_mappings,
+                            get_fhrs_mappings_options)
 from fhodot.app.parse_addresses import parse_establishment_address
 from fhodot.app.stats import get_fhrs_stats_features, get_osm_stats_features
 from fhodot.app.suggest import (get_suggested_matches_by_osm_id,
                                 get_full_osm_objects_query,
                                 get_full_fhrs_establishments_dict)
 from fhodot.app.utils import (
-    get_bbox, get_envelope, get_geojson_line, get_geojson_point,
-    get_geojson_feature_collection_string, num_objects_within_limit,
-    query_within_bbox)
+    get_bbox, get_envelope, get_features_stream_response, get_geojson_feature,
+    get_geojson_feature_collection, get_geojson_feature_collection_response,
+    get_geojson_line, get_geojson_point, get_json_response,
+    get_json_stream_response, get_stream_response, num_objects_within_limit,
+    query_within_bbox, stream_geojson_feature_collection)
 from fhodot.database import Session
 from fhodot.models import FHRSEstablishment, OSMFHRSMapping, OSMObject
 
@@ -30,7 +35,15 @@ from fhodot.models import FHRSEstablishment, OSMFHRSMapping, OSMObject
 # consistent path to allow redirect to wsgi-bin in production
 API_ROOT = "/api"
 
+# seconds for which browsers and proxies may cache bbox responses. Data
+# is only imported daily, but distant and suggested matches are used to
+# find data to fix, so are cached for less time to be up to date sooner
+# after each import.
+BBOX_CACHE_MAX_AGE = 3600
+BBOX_FIXES_CACHE_MAX_AGE = 300
+
 @app.route(f"{API_ROOT}/distant")
+@cache_control(BBOX_FIXES_CACHE_MAX_AGE)
 def data_distant():
     """OSM object data for objects with at least one distant FHRS match
 
@@ -39,104 +52,129 @@ def data_distant():
 
     osm_objects = query_within_bbox(OSMObject, get_bbox(request.args)).\
         filter(OSMObject.fhrs_mappings.any(OSMFHRSMapping.distant)).\
-        options(joinedload("fhrs_mappings").joinedload("fhrs_establishment"),
-                undefer("fhrs_mappings.distance"))
+        options(defer(OSMObject.location), # lat/lon used instead
+                *get_fhrs_mappings_options(include_distance=True)).\
+        yield_per(500)
 
-    point_features = []
-    line_features = []
-    for osm_object in osm_objects:
-        properties = get_selected_osm_properties(osm_object)
+    line_features = [] # populated as point features are streamed
 
-        properties["fhrsMappings"] = get_fhrs_mappings(
-            osm_object, include_distance=True, include_location=True)
-        for fhrs_mapping in properties["fhrsMappings"]:
-            fhrs_est = fhrs_mapping["fhrsEstablishment"]
-            line_features.append(
-                get_geojson_line(
-                    [{"lat": osm_object.lat, "lon": osm_object.lon},
-                     {"lat": fhrs_est["lat"], "lon": fhrs_est["lon"]}]))
+    def generate_point_features():
+        for osm_object in osm_objects:
+            properties = get_selected_osm_properties(osm_object)
 
-        point_features.append(
-            get_geojson_point(osm_object.lat, osm_object.lon, properties))
+            properties["fhrsMappings"] = get_fhrs_mappings(
+                osm_object, include_distance=True, include_location=True)
+            for fhrs_mapping in properties["fhrsMappings"]:
+                fhrs_est = fhrs_mapping["fhrsEstablishment"]
+                line_features.append(
+                    get_geojson_line(
+                        [{"lat": osm_object.lat, "lon": osm_object.lon},
+                         {"lat": fhrs_est["lat"], "lon": fhrs_est["lon"]}]))
 
-    points_feature_collection = FeatureCollection(point_features)
-    lines_feature_collection = FeatureCollection(line_features)
+            yield get_geojson_point(osm_object.lat, osm_object.lon,
+                                    properties)
 
-    return dumps({"points": points_feature_collection,
-                  "lines": lines_feature_collection}) # dump to JSON string
+    def generate_json():
+        yield b'{"points":'
+        yield from stream_geojson_feature_collection(
+            generate_point_features())
+        yield b',"lines":'
+        yield dumps(get_geojson_feature_collection(line_features))
+        yield b"}"
+
+    return get_json_stream_response(generate_json())
 
 
 @app.route(f"{API_ROOT}/fhrs")
+@cache_control(BBOX_CACHE_MAX_AGE)
 def data_fhrs():
-    """FHRS establishment data for a bounding box in GeoJSON format"""
+    """FHRS establishment data for a bounding box in GeoJSON format
+
+    Use the format=ndjson URL parameter for newline-delimited features.
+    """
 
     bbox = get_bbox(request.args)
     if not num_objects_within_limit(FHRSEstablishment, bbox, 10000):
         abort(413)
     establishments = query_within_bbox(FHRSEstablishment, bbox).\
         order_by(FHRSEstablishment.postcode, FHRSEstablishment.name).\
-        options(joinedload("osm_mappings").joinedload("osm_object"),
-                undefer("osm_mappings.distance"))
-
-    features = []
-    for est in establishments:
-        properties = get_selected_fhrs_properties(est)
-        properties["osmMappings"] = get_osm_mappings(est,
-                                                     include_distance=True)
-        features.append(get_geojson_point(est.lat, est.lon, properties))
+        options(load_only("fhrs_id", "name", "postcode", "postcode_original",
+                          "rating_date", "lat", "lon"),
+                *get_osm_mappings_options(include_distance=True)).\
+        yield_per(500)
 
     establishments_without_location = (
         query_fhrs_without_location_for_districts_in_bbox(bbox).\
-        options(joinedload("osm_mappings").joinedload("osm_object"),
-                joinedload("authority")))
-
-    for est in establishments_without_location:
-        properties = get_selected_fhrs_properties(est)
-        if not est.location:
-            properties["address1"] = est.address_1
-            properties["address2"] = est.address_2
-            properties["address3"] = est.address_3
-            properties["address4"] = est.address_4
-        properties["osmMappings"] = get_osm_mappings(est)
-        properties["authorityName"] = est.authority.name
-        features.append(Feature(properties=properties))
-
-    return get_geojson_feature_collection_string(features)
+        options(*get_osm_mappings_options(),
+                joinedload(FHRSEstablishment.authority)).\
+        yield_per(500))
+
+    def generate_features():
+        for est in establishments:
+            properties = get_selected_fhrs_properties(est)
+            properties["osmMappings"] = get_osm_mappings(
+                est, include_distance=True)
+            yield get_geojson_point(est.lat, est.lon, properties)
+
+        for est in establishments_without_location:
+            properties = get_selected_fhrs_properties(est)
+            if not est.location:
+                properties["address1"] = est.address_1
+                properties["address2"] = est.address_2
+                properties["address3"] = est.address_3
+                properties["address4"] = est.address_4
+            properties["osmMappings"] = get_osm_mappings(est)
+            properties["authorityName"] = est.authority.name
+            yield get_geojson_feature(properties=properties)
+
+    return get_features_stream_response(generate_features())
 
 
 @app.route(f"{API_ROOT}/osm")
+@cache_control(BBOX_CACHE_MAX_AGE)
 def data_osm():
-    """OSM object data for a bounding box in GeoJSON format"""
+    """OSM object data for a bounding box in GeoJSON format
+
+    Use the format=ndjson URL parameter for newline-delimited features.
+    """
 
     bbox = get_bbox(request.args)
     if not num_objects_within_limit(OSMObject, bbox, 10000):
         abort(413)
     osm_objects = query_within_bbox(OSMObject, bbox).\
         order_by(OSMObject.addr_postcode, OSMObject.name).\
-        options(joinedload("fhrs_mappings").joinedload("fhrs_establishment"),
-                undefer("fhrs_mappings.distance"))
+        options(defer(OSMObject.location), # lat/lon used instead
+                *get_fhrs_mappings_options(include_distance=True)).\
+        yield_per(500)
 
-    features = []
-    for osm_object in osm_objects:
-        properties = get_selected_osm_properties(osm_object)
-        properties["fhrsMappings"] = get_fhrs_mappings(osm_object,
-                                                       include_distance=True)
-        features.append(
-            get_geojson_point(osm_object.lat, osm_object.lon, properties))
+    def generate_features():
+        for osm_object in osm_objects:
+            properties = get_selected_osm_properties(osm_object)
+            properties["fhrsMappings"] = get_fhrs_mappings(
+                osm_object, include_distance=True)
+            yield get_geojson_point(osm_object.lat, osm_object.lon,
+                                    properties)
 
-    return get_geojson_feature_collection_string(features)
+    return get_features_stream_response(generate_features())
 
 
 @app.route(f"{API_ROOT}/fhrs/<int:fhrs_id>")
 def data_fhrs_single(fhrs_id):
     """Properties for an FHRS establishment including parsed address"""
-    fhrs_establishment = Session.query(FHRSEstablishment).get(fhrs_id)
+    # only load columns used by get_selected_fhrs_properties and
+    # parse_establishment_address, plus mappings for numbers of matches
+    fhrs_establishment = Session.query(FHRSEstablishment).\
+        options(load_only("fhrs_id", "name", "address_1", "address_2",
+                          "address_3", "address_4", "postcode",
+                          "postcode_original", "rating_date"),
+                *get_osm_mappings_options()).\
+        get(fhrs_id)
     if not fhrs_establishment:
         abort(404)
     properties = get_selected_fhrs_properties(fhrs_establishment)
     properties["parsedAddress"] = parse_establishment_address(
         fhrs_establishment)
-    return properties
+    return get_json_response(properties)
 
 
 @app.route(f"{API_ROOT}/postcode")
@@ -151,10 +189,22 @@ def data_postcode():
         abort(413)
     envelope = get_envelope(bbox)
 
+    # mappings (and both sides of each, used by postcodes_match) loaded
+    # for the numbers of matches with a SELECT ... IN query per
+    # relationship rather than lazily for each object and mapping
+    osm_mappings = FHRSEstablishment.osm_mappings
+    fhrs_mappings = OSMObject.fhrs_mappings
     result = Session.query(OSMObject, FHRSEstablishment).\
         filter(ST_Intersects(OSMObject.location, envelope)).\
         join(FHRSEstablishment,
             OSMObject.addr_postcode == FHRSEstablishment.postcode).\
+        options(
+            selectinload(fhrs_mappings).\
+                joinedload(OSMFHRSMapping.fhrs_establishment),
+            selectinload(fhrs_mappings).joinedload(OSMFHRSMapping.osm_object),
+            selectinload(osm_mappings).joinedload(OSMFHRSMapping.osm_object),
+            selectinload(osm_mappings).\
+                joinedload(OSMFHRSMapping.fhrs_establishment)).\
         order_by(OSMObject.addr_postcode, OSMObject.name, 
                  OSMObject.osm_id_single_space, FHRSEstablishment.name,
                  FHRSEstablishment.fhrs_id)
@@ -185,10 +235,11 @@ def data_postcode():
         features.append(
             get_geojson_point(osm_object.lat, osm_object.lon, properties))
 
-    return get_geojson_feature_collection_string(features)
+    return get_geojson_feature_collection_response(features)
 
 
 @app.route(f"{API_ROOT}/stats_fhrs")
+@cached_response()
 def data_stats_fhrs():
     """Local authority boundaries and statistics for FHRS objects"""
 
@@ -199,10 +250,11 @@ def data_stats_fhrs():
         abort(400)
 
     features = get_fhrs_stats_features(get_bbox(request.args), zoom)
-    return get_geojson_feature_collection_string(features)
+    return get_geojson_feature_collection_response(features)
 
 
 @app.route(f"{API_ROOT}/stats_osm")
+@cached_response()
 def data_stats_osm():
     """Local authority boundaries and statistics for OSM objects"""
 
@@ -213,12 +265,16 @@ def data_stats_osm():
         abort(400)
 
     features = get_osm_stats_features(get_bbox(request.args), zoom)
-    return get_geojson_feature_collection_string(features)
+    return get_geojson_feature_collection_response(features)
 
 
 @app.route(f"{API_ROOT}/suggest")
+@cache_control(BBOX_FIXES_CACHE_MAX_AGE)
 def data_suggest():
-    """OSM objects with suggested matches for a bbox in GeoJSON format"""
+    """OSM objects with suggested matches for a bbox in GeoJSON format
+
+    Use the format=ndjson URL parameter for newline-delimited features.
+    """
 
     bbox = get_bbox(request.args)
     if not num_objects_within_limit(OSMObject, bbox, 1000):
@@ -229,23 +285,23 @@ def data_suggest():
     fhrs_establishments_full_by_id = get_full_fhrs_establishments_dict(
         matches_by_osm_id)
 
-    # create a list of features that will become a GeoJSON feature collection
-    features = []
-    for osm_object in osm_objects_full:
-        properties = get_selected_osm_properties(osm_object)
-        properties["fhrsMappings"] = get_fhrs_mappings(osm_object)
-        properties["suggestedMatches"] = []
-        osm_id = osm_object.osm_id_single_space
-        for suggested_match in matches_by_osm_id[osm_id]:
-            suggested_match_full = fhrs_establishments_full_by_id[
-                suggested_match.fhrs_id]
-            est_properties = get_selected_fhrs_properties(suggested_match_full)
-            properties["suggestedMatches"].append(est_properties)
+    def generate_features():
+        for osm_object in osm_objects_full:
+            properties = get_selected_osm_properties(osm_object)
+            properties["fhrsMappings"] = get_fhrs_mappings(osm_object)
+            properties["suggestedMatches"] = []
+            osm_id = osm_object.osm_id_single_space
+            for suggested_match in matches_by_osm_id[osm_id]:
+                suggested_match_full = fhrs_establishments_full_by_id[
+                    suggested_match.fhrs_id]
+                est_properties = get_selected_fhrs_properties(
+                    suggested_match_full)
+                properties["suggestedMatches"].append(est_properties)
 
-        features.append(
-            get_geojson_point(osm_object.lat, osm_object.lon, properties))
+            yield get_geojson_point(osm_object.lat, osm_object.lon,
+                                    properties)
 
-    return get_geojson_feature_collection_string(features)
+    return get_features_stream_response(generate_features())
 
 
 @app.route(f"{API_ROOT}/surveyme")
@@ -254,20 +310,39 @@ def data_suggest():
 def data_surveyme():
     """CSV of incorrect fhrs:ids for Robert Whittaker's Survey Me!"""
 
-    query = Session.query(OSMFHRSMapping).\
-        filter(OSMFHRSMapping.fhrs_establishment == None).\
-        options(joinedload("osm_object")) # pylint: disable=singleton-comparison
-
-    string_io = StringIO()
-    csv_writer = writer(string_io)
-    csv_writer.writerow(["type", "id", "lat", "lon", "name", "fhrs:id"])
-    for mapping in query:
-        osm = mapping.osm_object
-        csv_writer.writerow([osm.osm_type[0], osm.osm_id_by_type, osm.lat,
-                             osm.lon, osm.name, mapping.fhrs_id])
-
-    response = make_response(string_io.getvalue())
-    response.headers[
-        "Content-Disposition"] = "attachment; filename=surveyme.csv"
-    response.headers["Content-type"] = "text/csv"
-    return response
+    # outer join rather than comparing the relationship with None, which
+    # would generate a NOT EXISTS subquery, and only select the columns
+    # needed rather than constructing ORM objects
+    query = Session.query(
+        OSMObject.osm_type, OSMObject.osm_id_by_type, OSMObject.lat,
+        OSMObject.lon, OSMObject.name, OSMFHRSMapping.fhrs_id).\
+        select_from(OSMFHRSMapping).\
+        join(OSMObject).\
+        outerjoin(FHRSEstablishment,
+                  OSMFHRSMapping.fhrs_id == FHRSEstablishment.fhrs_id).\
+        filter(FHRSEstablishment.fhrs_id.is_(None)).\
+        yield_per(1000)
+
+    def generate_csv():
+        """Yield CSV as UTF-8 bytes in batches of rows"""
+        buffer = BytesIO()
+        text = TextIOWrapper(buffer, encoding="utf-8", newline="",
+                             write_through=True)
+        csv_writer = writer(text)
+        csv_writer.writerow(["type", "id", "lat", "lon", "name", "fhrs:id"])
+        # only the first letter of the OSM type is used
+        rows = ((row[0][0], *row[1:]) for row in query)
+        while True:
+            # writerows loops over each batch in C
+            batch = list(islice(rows, 1000))
+            if not batch:
+                break
+            csv_writer.writerows(batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    return get_stream_response(
+        generate_csv(), "text/csv",
+        headers={"Content-Disposition": "attachment; filename=surveyme.csv"})
@@ -2,67 +2,159 @@
 
 
 from itertools import groupby
+from logging import warning
 
 from geoalchemy2 import Geometry
 from geoalchemy2.functions import (ST_AsGeoJSON, ST_Intersects,
                                    ST_SimplifyPreserveTopology)
-from geojson import Feature, loads
-from sqlalchemy import cast, func
-
-from fhodot.app.utils import get_envelope
+from orjson import Fragment
+from redis.exceptions import RedisError
+from sqlalchemy import and_, cast, func
+from sqlalchemy.orm import contains_eager
+
+from fhodot.app.cache import redis_client
+from fhodot.app.utils import (COORDINATE_DECIMAL_PLACES, get_envelope,
+                              get_geojson_feature)
 from fhodot.database import Session
 from fhodot.models import (FHRSAuthority, FHRSAuthorityStatistic,
                            LocalAuthorityDistrict,
                            OSMLocalAuthorityDistrictStatistic)
 
 
+# boundaries rarely change, so simplified versions can be cached for a
+# long time
+BOUNDARY_CACHE_TTL = 86400
+
+
 def get_pixel_size_degrees_for_zoom_level(zoom):
     """Returns size of one pixel in degrees for given zoom level"""
     return 360 / ((2**zoom) * 256)
 
 
+def get_latest_dates_cte(code_column):
+    """Returns CTE of latest statistics date for each authority/district
+
+    code_column is the statistics table's authority/district code
+    column. Ordering both columns descending lets Postgres use the
+    table's (code, date, statistic) primary key index for DISTINCT ON.
+    """
+    date_column = code_column.class_.date
+    return Session.query(code_column, date_column).\
+        distinct(code_column).\
+        order_by(code_column.desc(), date_column.desc()).\
+        cte("latest")
+
+
+def get_total_column(code_column):
+    """Returns column of total of statistics for each authority/district
+
+    code_column is the statistics table's authority/district code
+    column. The total is calculated by Postgres using a window function
+    and repeated on every row for that authority/district.
+    """
+    value_column = code_column.class_.value
+    return func.sum(value_column).over(partition_by=code_column).\
+        label("total")
+
+
+def get_boundary_cache_key(district_code, zoom):
+    """Return Redis key for a district's simplified boundary"""
+    return f"fhodot:boundary:{district_code}:{zoom}"
+
+
+def get_simplified_boundaries_geojson(district_codes, zoom):
+    """Returns dict of simplified GeoJSON boundaries for districts
+
+    Boundaries are fetched from the Redis cache where possible. Any
+    others are simplified for the zoom level in a single query and then
+    cached. Keys are district codes and values are GeoJSON geometry
+    strings or bytes.
+    """
+    district_codes = list(district_codes)
+    if not district_codes:
+        return {}
+    keys = [get_boundary_cache_key(code, zoom) for code in district_codes]
+
+    try:
+        cached = redis_client.mget(keys)
+    except RedisError:
+        warning("Could not fetch boundaries from Redis cache")
+        cached = [None] * len(keys)
+    boundaries_geojson = {code: geojson for code, geojson
+                          in zip(district_codes, cached) if geojson}
+
+    missing_codes = [code for code in district_codes
+                     if code not in boundaries_geojson]
+    if not missing_codes:
+        return boundaries_geojson
+
+    query = Session.query(
+        LocalAuthorityDistrict.code,
+        ST_AsGeoJSON(ST_SimplifyPreserveTopology(
+            cast(LocalAuthorityDistrict.boundary, Geometry),
+            get_pixel_size_degrees_for_zoom_level(zoom)),
+            COORDINATE_DECIMAL_PLACES)
+    ).\
+    filter(LocalAuthorityDistrict.code.in_(missing_codes))
+    fetched = dict(query)
+    boundaries_geojson.update(fetched)
+
+    try:
+        pipeline = redis_client.pipeline()
+        for code, geojson in fetched.items():
+            pipeline.setex(get_boundary_cache_key(code, zoom),
+                           BOUNDARY_CACHE_TTL, geojson)
+        pipeline.execute()
+    except RedisError:
+        warning("Could not store boundaries in Redis cache")
+
+    return boundaries_geojson
+
+
 def get_fhrs_stats_features(bbox, zoom):
     """Returns list of GeoJSON features for districts with FHRS stats"""
 
-    subquery = Session.query(
-        func.max(FHRSAuthorityStatistic.date).label("latest")
-    ).subquery()
+    latest = get_latest_dates_cte(FHRSAuthorityStatistic.authority_code)
 
-    stats_long = Session.query(FHRSAuthorityStatistic).\
+    stats_long = Session.query(
+        FHRSAuthorityStatistic,
+        get_total_column(FHRSAuthorityStatistic.authority_code)).\
         select_from(FHRSAuthorityStatistic).\
         filter(
-            FHRSAuthorityStatistic.date == subquery.c.latest,
             ST_Intersects(LocalAuthorityDistrict.boundary, get_envelope(bbox))
         ).\
+        join(latest, and_(
+            FHRSAuthorityStatistic.authority_code == latest.c.authority_code,
+            FHRSAuthorityStatistic.date == latest.c.date)).\
         join(FHRSAuthority,
              FHRSAuthority.code == FHRSAuthorityStatistic.authority_code).\
         join(LocalAuthorityDistrict).\
+        options(contains_eager(FHRSAuthorityStatistic.authority)).\
+        order_by(FHRSAuthorityStatistic.authority_code).\
         all()
 
-    stats_by_authority = groupby(stats_long,
-                                 lambda instance: instance.authority)
+    # one query for all boundaries rather than one per authority
+    boundaries_geojson = get_simplified_boundaries_geojson(
+        {item.authority.district_code for item, _ in stats_long}, zoom)
+
+    stats_by_authority = groupby(stats_long, lambda row: row[0].authority)
 
     features = []
-    for authority, stats in stats_by_authority:
-        boundary_geojson = Session.query(
-            ST_AsGeoJSON(ST_SimplifyPreserveTopology(
-                cast(LocalAuthorityDistrict.boundary, Geometry),
-                get_pixel_size_degrees_for_zoom_level(zoom)))
-        ).\
-        select_from(FHRSAuthority).\
-        join(LocalAuthorityDistrict).\
-        filter(FHRSAuthority.code == authority.code).\
-        scalar()
+    for authority, rows in stats_by_authority:
+        boundary_geojson = boundaries_geojson[authority.district_code]
 
+        rows = list(rows)
         properties = {
             "name": authority.name,
-            "districtCode": authority.district.code,
-            "stats": {item.statistic: item.value for item in stats}
+            "districtCode": authority.district_code,
+            "stats": {item.statistic: item.value for item, _ in rows}
         }
-        properties["stats"]["total"] = sum(properties["stats"].values())
+        properties["stats"]["total"] = rows[0].total
 
-        features.append(Feature(geometry=loads(boundary_geojson),
-                                properties=properties))
+        # geometry JSON from PostGIS included as is rather than being
+        # parsed into Python objects and serialised again
+        features.append(get_geojson_feature(Fragment(boundary_geojson),
+                                            properties))
 
     return features
 
@@ -70,40 +162,47 @@ def get_fhrs_stats_features(bbox, zoom):
 def get_osm_stats_features(bbox, zoom):
     """Returns list of GeoJSON features for districts with OSM stats"""
 
-    subquery = Session.query(
-        func.max(OSMLocalAuthorityDistrictStatistic.date).label("latest")
-    ).subquery()
+    latest = get_latest_dates_cte(
+        OSMLocalAuthorityDistrictStatistic.district_code)
 
-    stats_long = Session.query(OSMLocalAuthorityDistrictStatistic).\
+    stats_long = Session.query(
+        OSMLocalAuthorityDistrictStatistic,
+        get_total_column(OSMLocalAuthorityDistrictStatistic.district_code)).\
         filter(
-            OSMLocalAuthorityDistrictStatistic.date == subquery.c.latest,
             ST_Intersects(LocalAuthorityDistrict.boundary, get_envelope(bbox))
         ).\
+        join(latest, and_(
+            (OSMLocalAuthorityDistrictStatistic.district_code ==
+             latest.c.district_code),
+            OSMLocalAuthorityDistrictStatistic.date == latest.c.date)).\
         join(LocalAuthorityDistrict,
              (OSMLocalAuthorityDistrictStatistic.district_code ==
               LocalAuthorityDistrict.code)).\
+        options(contains_eager(OSMLocalAuthorityDistrictStatistic.district)).\
+        order_by(OSMLocalAuthorityDistrictStatistic.district_code).\
         all()
 
-    stats_by_district = groupby(stats_long, lambda instance: instance.district)
+    # one query for all boundaries rather than one per district
+    boundaries_geojson = get_simplified_boundaries_geojson(
+        {item.district_code for item, _ in stats_long}, zoom)
+
+    stats_by_district = groupby(stats_long, lambda row: row[0].district)
 
     features = []
-    for district, stats in stats_by_district:
-        boundary_geojson = Session.query(
-            ST_AsGeoJSON(ST_SimplifyPreserveTopology(
-                cast(LocalAuthorityDistrict.boundary, Geometry),
-                get_pixel_size_degrees_for_zoom_level(zoom)))
-        ).\
-        filter(LocalAuthorityDistrict.code == district.code).\
-        scalar()
+    for district, rows in stats_by_district:
+        boundary_geojson = boundaries_geojson[district.code]
 
+        rows = list(rows)
         properties = {
             "name": district.name,
             "districtCode": district.code,
-            "stats": {item.statistic: item.value for item in stats}
+            "stats": {item.statistic: item.value for item, _ in rows}
         }
-        properties["stats"]["total"] = sum(properties["stats"].values())
+        properties["stats"]["total"] = rows[0].total
 
-        features.append(Feature(geometry=loads(boundary_geojson),
-                                properties=properties))
+        # geometry JSON from PostGIS included as is rather than being
+        # parsed into Python objects and serialised again
+        features.append(get_geojson_feature(Fragment(boundary_geojson),
+                                            properties))
 
     return features
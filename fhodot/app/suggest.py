@@ -1,20 +1,45 @@
 """Functions to suggest matching FHRS establishments for an OSM object"""
 
 from collections import defaultdict
+from functools import lru_cache
 from itertools import chain
-from re import sub
+from re import compile as re_compile
 
-from fuzzywuzzy.fuzz import token_set_ratio
 from geoalchemy2.functions import ST_DWithin, ST_Intersects
+from rapidfuzz.fuzz import token_set_ratio
+from rapidfuzz.process import extract
 from sqlalchemy import not_
-from sqlalchemy.orm import joinedload, Load
+from sqlalchemy.orm import Load
 from unidecode import unidecode
 
 from fhodot.database import Session
 from fhodot.models import FHRSEstablishment, OSMObject
+from fhodot.app.fhrs import get_osm_mappings_options
+from fhodot.app.osm import get_fhrs_mappings_options
 from fhodot.app.utils import get_envelope
 
 
+# how similar names have to be (0-100) to be considered a match, chosen
+# by looking at examples
+NAME_RATIO_THRESHOLD = 90
+
+# substitutions applied by standardise_name, in the order listed
+PUNCTUATION_TO_SPACE_REGEX = re_compile("[./-]")
+SYMBOL_REGEX = re_compile(r" ?([&+@]) ?")
+SYMBOL_WORDS = {"&": " and ", "+": " and ", "@": " at "}
+EXTRANEOUS_REGEX = re_compile(r"[^a-z0-9\s]")
+LTD_REGEX = re_compile(r"\bltd\b") # \b is a word boundary
+WHITESPACE_REGEX = re_compile(r"\s+")
+
+
+def replace_symbol(match):
+    """Return word for symbol matched by SYMBOL_REGEX"""
+    return SYMBOL_WORDS[match.group(1)]
+
+
+# the same OSM and FHRS names are standardised repeatedly when comparing
+# nearby combinations, so memoise results (bounded to limit memory use)
+@lru_cache(maxsize=100000)
 def standardise_name(string):
     """Standardise a name string to improve results of fuzzy matching
 
@@ -24,37 +49,37 @@ def standardise_name(string):
     string = unidecode(string) # unaccent
     string = string.lower()
     # convert various characters to something specific
-    string = sub("[./-]", " ", string)
-    string = sub(r" ?& ?| ?\+ ?", " and ", string)
-    string = sub(" ?@ ?", " at ", string)
+    string = PUNCTUATION_TO_SPACE_REGEX.sub(" ", string)
+    string = SYMBOL_REGEX.sub(replace_symbol, string) # & + @ in one pass
     # remove any other extraneous characters
-    string = sub(r"[^a-z0-9\s]", "", string)
-    # remove 'ltd' (\b is a word boundary)
-    string = sub(r"\bltd\b", "", string)
+    string = EXTRANEOUS_REGEX.sub("", string)
+    # remove 'ltd'
+    string = LTD_REGEX.sub("", string)
     # normalise whitespace
     string = string.strip()
-    string = sub(r"\s+", " ", string)
+    string = WHITESPACE_REGEX.sub(" ", string)
     return string
 
 
-def standardised_names_match(osm_name_std, fhrs_name_std, ratio_threshold=90,
+def standardised_names_match(osm_name_std, fhrs_name_std,
+                             ratio_threshold=NAME_RATIO_THRESHOLD,
                              return_ratio=False):
     """Test whether two standardised names are a close match
 
-    Uses fuzzywuzzy's token set ratio method for fuzzy string matching.
+    Uses RapidFuzz's token set ratio method for fuzzy string matching.
     Returns True if the names are sufficiently matched and False
     otherwise.
 
     ratio_threshold (0-100) defines how similar the names have to be to
-    return True. Its default has been chosen by looking at examples.
+    return True.
 
     If return_ratio is True, the function will return the token set
     ratio itself rather than True if it is >= ratio_threshold, which can
     be used for analysis purposes.
     """
     # token_set_ratio checks for equality first so no need to here
-    # strings already standardised, so full_process not required
-    ratio = token_set_ratio(osm_name_std, fhrs_name_std, full_process=False)
+    # strings already standardised, so no processor required
+    ratio = token_set_ratio(osm_name_std, fhrs_name_std)
     if ratio >= ratio_threshold:
         return ratio if return_ratio else True
     return False
@@ -100,18 +125,21 @@ def get_suggested_matches_by_osm_id(bbox):
 
     # key: OSM ID, value: list of matching FHRS establishments
     matches_by_osm_id = defaultdict(list)
-    fhrs_names_std = {} # to store FHRS names already standardised
     for osm_object, fhrs_establishments in nearby_combinations_by_osm.items():
         osm_name_std = standardise_name(osm_object.name)
-        for fhrs_establishment in fhrs_establishments:
-            if fhrs_establishment.fhrs_id in fhrs_names_std:
-                fhrs_name_std = fhrs_names_std[fhrs_establishment.fhrs_id]
-            else:
-                fhrs_name_std = standardise_name(fhrs_establishment.name)
-                fhrs_names_std[fhrs_establishment.fhrs_id] = fhrs_name_std
-            if standardised_names_match(osm_name_std, fhrs_name_std):
-                matches_by_osm_id[osm_object.osm_id_single_space].append(
-                    fhrs_establishment)
+        # standardise_name caches results, so repeats are cheap
+        nearby_names_std = [standardise_name(fhrs_establishment.name)
+                            for fhrs_establishment in fhrs_establishments]
+
+        # score all nearby establishments' names in a single call
+        # (equivalent to standardised_names_match for each name)
+        matches = extract(osm_name_std, nearby_names_std,
+                          scorer=token_set_ratio,
+                          score_cutoff=NAME_RATIO_THRESHOLD, limit=None)
+        # extract sorts by score, so restore original order
+        for index in sorted(index for _, _, index in matches):
+            matches_by_osm_id[osm_object.osm_id_single_space].append(
+                fhrs_establishments[index])
 
     return matches_by_osm_id
 
@@ -124,7 +152,7 @@ def get_full_osm_objects_query(suggested_matches_by_osm_id):
     osm_ids = suggested_matches_by_osm_id.keys()
     return Session.query(OSMObject).\
         filter(OSMObject.osm_id_single_space.in_(osm_ids)).\
-        options(joinedload("fhrs_mappings").joinedload("fhrs_establishment"))
+        options(*get_fhrs_mappings_options())
 
 
 def get_full_fhrs_establishments_dict(suggested_matches_by_osm_id):
@@ -134,7 +162,9 @@ def get_full_fhrs_establishments_dict(suggested_matches_by_osm_id):
     """
     fhrs_ids = [fhrs_est.fhrs_id for fhrs_est
                 in chain.from_iterable(suggested_matches_by_osm_id.values())]
+    # mappings needed for the establishments' match counts
     fhrs_establishments_full = Session.query(FHRSEstablishment).\
-        filter(FHRSEstablishment.fhrs_id.in_(fhrs_ids))
+        filter(FHRSEstablishment.fhrs_id.in_(fhrs_ids)).\
+        options(*get_osm_mappings_options())
     return {fhrs_est.fhrs_id : fhrs_est for fhrs_est
             in fhrs_establishments_full}
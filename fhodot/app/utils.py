@@ -1,29 +1,36 @@
 """Utility functions for Flask API"""
 
 from logging import error
+from zlib import compressobj
 
-from flask import abort
+from flask import (abort, make_response, request, Response,
+                   stream_with_context)
 from geoalchemy2 import Geography
 from geoalchemy2.functions import ST_Intersects, ST_MakeEnvelope
-from geojson import dumps, Feature, FeatureCollection, LineString, Point
-from sqlalchemy import cast
+from orjson import dumps, OPT_APPEND_NEWLINE
+from sqlalchemy import cast, func, literal
+from sqlalchemy.orm import raiseload, selectinload
 
 from fhodot.database import Session
-from fhodot.models import FHRSEstablishment, OSMObject
+from fhodot.models import FHRSEstablishment, OSMFHRSMapping, OSMObject
+
+
+# 6 decimal places of a degree is ~0.1m, more than enough for map
+# markers, and avoids sending ~17 significant digits per coordinate
+COORDINATE_DECIMAL_PLACES = 6
+
+# same as COMPRESS_LEVEL for Flask-Compress
+GZIP_LEVEL = 5
 
 
 def get_bbox(args):
     """Get and validate bounding box from URL parameters"""
 
-    bbox = {"l": None, "b": None, "r": None, "t": None}
-    for side in bbox.keys(): # pylint: disable=consider-iterating-dictionary
-        parameter = args.get(side)
-        try:
-            bbox[side] = float(parameter)
-        except (ValueError, TypeError):
-            error("Bounding box parameters not specified correctly")
-            abort(400)
-    return bbox
+    try:
+        return {side: float(args[side]) for side in ("l", "b", "r", "t")}
+    except (KeyError, ValueError, TypeError):
+        error("Bounding box parameters not specified correctly")
+        abort(400)
 
 
 def get_envelope(bbox):
@@ -35,12 +42,18 @@ def get_envelope(bbox):
 
 
 def num_objects_within_limit(object_class, bbox, limit):
-    """Check whether number of objects within bounding box <= limit"""
+    """Check whether number of objects within bounding box <= limit
+
+    Counts at most limit + 1 rows, selecting a constant rather than
+    loading any columns, so the database can stop scanning early.
+    """
     envelope = get_envelope(bbox)
-    count = Session.query(object_class).\
+    subquery = Session.query(literal(1)).\
+        select_from(object_class).\
         filter(ST_Intersects(object_class.location, envelope)).\
         limit(limit + 1).\
-        count()
+        subquery()
+    count = Session.query(func.count()).select_from(subquery).scalar()
     return count <= limit
 
 
@@ -63,27 +76,150 @@ def query_within_bbox(object_class, bbox):
     return result
 
 
+def get_mappings_options(mappings, include_distance=False):
+    """Get loader options for a mappings relationship and its objects
+
+    mappings: OSMObject.fhrs_mappings or FHRSEstablishment.osm_mappings
+
+    The mappings collection is loaded using a separate SELECT ... IN
+    query rather than a join to avoid multiplying the rows returned.
+    Both objects in each mapping are joined because postcodes_match
+    uses them, and any other lazy load raises an exception rather than
+    silently issuing a query per object.
+    """
+    options = [
+        selectinload(mappings).joinedload(OSMFHRSMapping.osm_object),
+        selectinload(mappings).joinedload(OSMFHRSMapping.fhrs_establishment),
+        selectinload(mappings).raiseload("*"),
+        raiseload("*")]
+    if include_distance:
+        options.append(
+            selectinload(mappings).undefer(OSMFHRSMapping.distance))
+    return options
+
+
+def get_geojson_feature(geometry=None, properties=None):
+    """Returns a GeoJSON feature as a plain dict
+
+    Geometry may be None e.g. for an establishment without a location.
+    """
+    return {"type": "Feature",
+            "geometry": geometry,
+            "properties": properties if properties is not None else {}}
+
+
+def round_coordinate(value):
+    """Round a lat/lon coordinate, leaving None unchanged"""
+    if value is None:
+        return None
+    return round(value, COORDINATE_DECIMAL_PLACES)
+
+
 def get_geojson_point(lat, lon, properties):
     """Returns a GeoJSON feature with Point geometry"""
-    # pass a tuple to Point
-    return Feature(geometry=Point((lon, lat)), properties=properties)
+    return get_geojson_feature(
+        {"type": "Point",
+         "coordinates": [round_coordinate(lon), round_coordinate(lat)]},
+        properties)
 
 
 def get_geojson_line(points):
     """Returns a GeoJSON feature with LineString geometry
 
-    Points argument should be a list of objects with lat and lon.
+    Points argument should be a list of dicts with lat and lon keys.
+    """
+    return get_geojson_feature(
+        {"type": "LineString",
+         "coordinates": [[round_coordinate(point["lon"]),
+                          round_coordinate(point["lat"])]
+                         for point in points]})
+
+
+def get_geojson_feature_collection(features):
+    """Returns a GeoJSON FeatureCollection as a plain dict"""
+    return {"type": "FeatureCollection", "features": features}
+
+
+def get_json_response(obj):
+    """Returns a JSON response for a dict/list serialised using orjson
+
+    orjson produces bytes directly, which is considerably quicker than
+    the standard library's json module for large responses.
+    """
+    return make_response(
+        (dumps(obj), 200, {"Content-Type": "application/json"}))
+
+
+def get_geojson_feature_collection_response(features):
+    """Returns a JSON response containing a GeoJSON FeatureCollection"""
+    return get_json_response(get_geojson_feature_collection(features))
+
+
+def stream_geojson_feature_collection(features):
+    """Yield a GeoJSON FeatureCollection as JSON bytes in chunks
+
+    Features (an iterable of feature dicts) are serialised one at a time
+    so that neither all the features nor the whole JSON string need to
+    be held in memory.
+    """
+    yield b'{"type":"FeatureCollection","features":['
+    separator = b""
+    for feature in features:
+        yield separator + dumps(feature)
+        separator = b","
+    yield b"]}"
+
+
+def gzip_chunks(chunks):
+    """Yield gzip-compressed bytes from an iterable of bytes
+
+    Compressed data is yielded whenever zlib's internal buffer fills
+    rather than for every chunk, so small chunks compress well.
+    """
+    compressor = compressobj(GZIP_LEVEL, wbits=31) # 31: gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def get_stream_response(chunks, mimetype, headers=None):
+    """Returns a response streaming an iterable of bytes
+
+    The request context is kept so that queries can continue to be
+    iterated over while the response is streamed. Flask-Compress would
+    buffer the whole response to compress it, so the stream is gzipped
+    as it is generated if the client accepts this.
+    """
+    headers = dict(headers or {}, Vary="Accept-Encoding")
+    if "gzip" in request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers=headers)
+
+
+def get_json_stream_response(chunks):
+    """Returns a response streaming JSON from an iterable of bytes"""
+    return get_stream_response(chunks, "application/json")
+
+
+def stream_ndjson_features(features):
+    """Yield newline-delimited GeoJSON features as JSON bytes"""
+    for feature in features:
+        yield dumps(feature, option=OPT_APPEND_NEWLINE)
+
+
+def get_features_stream_response(features):
+    """Returns a response streaming features from an iterable
+
+    Streams a GeoJSON FeatureCollection by default, or newline-delimited
+    GeoJSON features (one per line) if the format URL parameter is
+    'ndjson'.
     """
-    assert isinstance(points, list)
-    for point in points:
-        assert isinstance(point, dict)
-        assert "lat" in point and "lon" in point
-    # pass a list of tuples to LineString
-    return Feature(geometry=LineString(
-        [(point["lon"], point["lat"]) for point in points]))
-
-
-def get_geojson_feature_collection_string(features):
-    """Returns a GeoJSON FeatureCollection as a string"""
-    feature_collection = FeatureCollection(features)
-    return dumps(feature_collection) # dump to JSON string
+    if request.args.get("format") == "ndjson":
+        return get_stream_response(stream_ndjson_features(features),
+                                   "application/x-ndjson")
+    return get_json_stream_response(
+        stream_geojson_feature_collection(features))
@@ -1,37 +1,57 @@
 """Module for importing ONS Local Authority Districts boundaries"""
 
+from itertools import islice
+
 import fiona
+from geoalchemy2 import Geometry
 from geoalchemy2.functions import ST_Transform
 from geoalchemy2.shape import from_shape
 from shapely.geometry import shape
 from shapely.geometry.multipolygon import MultiPolygon
 from shapely.geometry.polygon import Polygon
+from sqlalchemy import bindparam
 
 from fhodot.database import Session
 from fhodot.models import LocalAuthorityDistrict
 
 
-def add_boundaries_to_session(shapefile_path, field_prefix):
-    """Read boundaries from shapefile and add to database session
+def get_boundary_rows(collection, field_prefix):
+    """Yield dicts of code, name and boundary WKB for shapefile features"""
+    for feature in collection:
+        properties = feature["properties"]
+        boundary = shape(feature["geometry"])
+        if isinstance(boundary, Polygon):
+            boundary = MultiPolygon([boundary])
+        yield {"code": properties[field_prefix + "CD"],
+               "name": properties[field_prefix + "NM"],
+               "boundary_wkb": from_shape(boundary, srid=27700)}
+
 
-    This doesn't commit the session.
+def add_boundaries_to_session(shapefile_path, field_prefix,
+                              batch_size=500):
+    """Read boundaries from shapefile and insert using database session
+
+    Boundaries are inserted in batches using a single INSERT statement
+    executed for many rows, rather than constructing ORM objects. This
+    doesn't commit the session.
 
     shapefile_path (string): path of boundaries shapefile
     field_prefix (string): prefix to code/name field names in shapefile
+    batch_size (int): number of boundaries to insert at a time
     """
 
+    # code and name bound from each row's dict by column name, boundary
+    # transformed to WGS84 by PostGIS
+    statement = LocalAuthorityDistrict.__table__.insert().values(
+        boundary=ST_Transform(
+            bindparam("boundary_wkb", type_=Geometry(srid=27700)), 4326))
+
     with fiona.open(shapefile_path) as collection:
         assert collection.crs["init"] == "epsg:27700"
 
-        for feature in collection:
-            properties = feature["properties"]
-            boundary = shape(feature["geometry"])
-            if isinstance(boundary, Polygon):
-                boundary = MultiPolygon([boundary])
-            wkb = from_shape(boundary, srid=27700)
-
-            Session.add(
-                LocalAuthorityDistrict(
-                    code=properties[field_prefix + "CD"],
-                    name=properties[field_prefix + "NM"],
-                    boundary=ST_Transform(wkb, 4326)))
+        rows = get_boundary_rows(collection, field_prefix)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            Session.execute(statement, batch)
@@ -37,7 +37,16 @@ from sqlalchemy.orm import scoped_session, sessionmaker
 
 from fhodot.config import DATABASE_URL
 
-engine = create_engine(DATABASE_URL)
+# pool sized for concurrent API requests, checking connections are
+# still alive before use and replacing them after half an hour.
+# executemany INSERTs are sent as multi-row VALUES statements (and other
+# executemany statements in batches) using psycopg2's fast execution
+# helpers, rather than one round trip per row.
+engine = create_engine(DATABASE_URL, pool_size=10, max_overflow=20,
+                       pool_pre_ping=True, pool_recycle=1800,
+                       executemany_mode="values",
+                       executemany_values_page_size=10000,
+                       executemany_batch_page_size=500)
 # see https://docs.sqlalchemy.org/en/13/orm/contextual.html
 Session = scoped_session(sessionmaker(bind=engine))
 
@@ -1,16 +1,82 @@
 """Module for downloading and importing FHRS data"""
 
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
 from logging import critical, debug, error, info, warning
-from xml.etree.ElementTree import fromstring, iselement, ParseError
 
-from requests import get
+from geoalchemy2.functions import ST_Distance, ST_DWithin, ST_Intersects
+from lxml.etree import iterparse, XMLSyntaxError
+from requests import Session as HTTPSession
 from requests.exceptions import RequestException
 from retrying import retry
-from sqlalchemy import desc, func
+from sqlalchemy import bindparam, case, desc, func, not_, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
 
 from fhodot.config import USER_AGENT
 from fhodot.database import Session
-from fhodot.models import FHRSAuthority, FHRSEstablishment
+from fhodot.models import (FHRSAuthority, FHRSEstablishment,
+                           LocalAuthorityDistrict, OSMFHRSMapping, OSMObject)
+from fhodot.models.mapping import DISTANT_THRESHOLD_METRES
+
+
+# rows per INSERT statement, keeping the number of bound parameters
+# well under Postgres's limit
+INSERT_BATCH_SIZE = 5000
+
+# if more than this proportion of an authority's establishments are in
+# one district, assume that they are associated
+DISTRICT_PROPORTION_THRESHOLD = 0.9
+
+# authority columns set from XML and updated when merging
+MERGED_AUTHORITY_COLUMNS = ("code", "name", "region_name", "last_published",
+                            "email", "xml_url")
+
+
+# establishment columns inserted when replacing establishments
+ESTABLISHMENT_COLUMNS = tuple(
+    column.key for column in FHRSEstablishment.__table__.columns)
+
+
+# reuse connections (and TLS handshakes) for the many requests to the
+# same FHRS hosts, with the user agent set once
+http_session = HTTPSession()
+http_session.headers["user-agent"] = USER_AGENT
+
+
+AUTHORITIES_NAMESPACE = (
+    "{http://schemas.datacontract.org/2004/07/FHRS.Model.Detailed}")
+AUTHORITY_TAG = AUTHORITIES_NAMESPACE + "authority"
+# (database field, XML tag) pairs with namespace prepended once, rather
+# than for every authority (last_published set using method)
+AUTHORITY_FIELD_TAGS = tuple(
+    (db_field, AUTHORITIES_NAMESPACE + xml_field)
+    for db_field, xml_field in (("code", "LocalAuthorityIdCode"),
+                                ("name", "Name"),
+                                ("region_name", "RegionName"),
+                                ("email", "Email"),
+                                ("xml_url", "FileName")))
+AUTHORITY_LAST_PUBLISHED_TAG = AUTHORITIES_NAMESPACE + "LastPublishedDate"
+
+# (database field, XML tag) pairs for establishments (location set using
+# method)
+ESTABLISHMENT_FIELD_TAGS = (
+    ("fhrs_id", "FHRSID"),
+    ("name", "BusinessName"),
+    ("postcode_original", "PostCode"),
+    # before address because if an address line contains a postcode, the
+    # address validator needs to check whether postcode already filled
+    ("postcode", "PostCode"),
+    # address in reverse order so that if postcode is in one or more
+    # address lines, latest postcode line is used
+    ("address_4", "AddressLine4"),
+    ("address_3", "AddressLine3"),
+    ("address_2", "AddressLine2"),
+    ("address_1", "AddressLine1"),
+    ("rating_date", "RatingDate"),
+    ("authority_code", "LocalAuthorityCode"))
 
 
 def retry_if_request_exception(exception):
@@ -22,15 +88,18 @@ def retry_if_request_exception(exception):
        wait_exponential_max=60000, # wait max 1'00" between attempts
        stop_max_delay=181000, # wait up to a maximum of 3'01"
        retry_on_exception=retry_if_request_exception) # don't retry on others
-def download_with_retries(url, headers=None, encoding=None, verify=None): # pragma: no cover
+def download_with_retries(url, headers=None, encoding=None, verify=None,
+                          as_bytes=False): # pragma: no cover
     """Download data from the internet
 
     If first attempt fails, wait and try again. The wait time increases
-    exponentially. The user agent header is added automatically.
+    exponentially. The user agent header is added automatically and
+    connections are reused between calls.
 
     url (string): the URL to download
     headers (dict): headers to add in addition to the user agent
     encoding (string): set to override the response encoding
+    as_bytes (bool): return the undecoded bytes rather than a string
 
     Return the data downloaded
     """
@@ -39,20 +108,23 @@ def download_with_retries(url, headers=None, encoding=None, verify=None): # prag
     headers = {} if headers is None else headers
     assert isinstance(headers, dict)
 
-    # merge user agent into headers
-    headers = {**headers, "user-agent": USER_AGENT}
-
     try:
-        response = get(url, headers=headers, verify=verify)
+        response = http_session.get(url, headers=headers, verify=verify)
         response.raise_for_status() # raise on 4xx or 5xx error
-    except RequestException: # should cover all requests exceptions
+    except RequestException as exception: # covers all requests exceptions
+        # response isn't set if the connection failed or dropped part way
+        # through reading the body, so log the exception (which includes
+        # any status code) rather than the response
         warning(
             "Error when trying to get data\n" +
-            f"URL: {response.url}\n" +
+            f"URL: {url}\n" +
             f"Headers: {headers}\n" +
-            f"Status code: {response.status_code}")
+            f"Error: {exception}")
         raise # caught by @retry unless final attempt fails
 
+    if as_bytes:
+        return response.content
+
     if encoding:
         response.encoding = encoding
 
@@ -64,69 +136,75 @@ def download_from_api(endpoint): # pragma: no cover
 
     endpoint (string): endpoint part of URL
 
-    Returns XML string
+    Returns XML bytes. The whole response is read within
+    download_with_retries, so that a connection dropped part way through
+    is retried, rather than being streamed to the parser.
     """
 
     api_base_url = "http://api.ratings.food.gov.uk/"
     api_headers = {"x-api-version": "2",
                    "accept": "application/xml"}
 
-    return download_with_retries(api_base_url + endpoint, api_headers)
+    return download_with_retries(api_base_url + endpoint, api_headers,
+                                 as_bytes=True)
 
 
 def download_authorities_from_api(): # pragma: no cover
     """Call api_download to download authorities
 
-    Returns XML string
+    Returns XML bytes
     """
     return download_from_api("Authorities")
 
 
-def get_xml_field(node, field, namespace=None):
-    """Get the text for a specified field from an XML node"""
+def iterparse_xml_nodes(xml, tag):
+    """Yield each node with the specified tag from XML
 
-    namespace = "" if namespace is None else namespace
-    string = None
+    xml (bytes, string or file-like object): XML to parse, where a
+        file-like object (e.g. an open file) is read as it is
+        parsed rather than being read into memory first
+
+    Nodes are parsed incrementally and each node and any preceding
+    siblings are cleared after it has been processed, so that memory
+    use doesn't grow with the size of the XML.
+    """
 
-    element = node.find(namespace + field)
-    if iselement(element):
-        string = element.text
+    if isinstance(xml, str):
+        xml = xml.encode("utf-8")
+    if isinstance(xml, bytes):
+        xml = BytesIO(xml)
 
-    assert string != "" # empty field should return None
-    return string
+    # don't expand entities from the downloaded XML's DTD, if any
+    for _, node in iterparse(xml, tag=tag, resolve_entities=False):
+        yield node
+        node.clear()
+        while node.getprevious() is not None:
+            del node.getparent()[0]
 
 
-def parse_xml_authorities(xml_string):
+def parse_xml_authorities(xml):
     """Parse FHRS authorities XML into FHRSAuthority objects
 
+    xml (bytes, string or file-like object): authorities XML
+
     Returns list of FHRSAuthority objects
     """
 
+    authorities = []
     try:
-        root = fromstring(xml_string)
-    except ParseError:
-        critical("Error parsing authorities XML file")
-        raise
+        for node in iterparse_xml_nodes(xml, AUTHORITY_TAG):
+            authority = FHRSAuthority()
 
-    namespace = "{http://schemas.datacontract.org/2004/07/FHRS.Model.Detailed}"
+            # findtext returns an empty string for an empty element
+            for db_field, tag in AUTHORITY_FIELD_TAGS:
+                setattr(authority, db_field, node.findtext(tag) or None)
+            authority.set_last_published_from_string(
+                node.findtext(AUTHORITY_LAST_PUBLISHED_TAG) or None)
 
-    authorities = []
-    for node in root.iter(namespace + "authority"):
-        authority = FHRSAuthority()
-
-        # last_updated set using method below
-        mapping = {"code": "LocalAuthorityIdCode",
-                   "name": "Name",
-                   "region_name": "RegionName",
-                   "email": "Email",
-                   "xml_url": "FileName"}
-        for db_field, xml_field in mapping.items():
-            setattr(authority, db_field,
-                    get_xml_field(node, xml_field, namespace))
-        authority.set_last_published_from_string(
-            get_xml_field(node, "LastPublishedDate", namespace))
-
-        authorities.append(authority)
+            authorities.append(authority)
+    except XMLSyntaxError:
+        critical("Error parsing authorities XML file")
+        raise
 
     return authorities
 
@@ -169,22 +247,25 @@ def get_authorities_requiring_fetch(authorities):
     Returns list of FHRSAuthority objects
     """
 
+    # last published dates of authorities already in the database, using
+    # one query rather than one per authority
+    codes = [authority.code for authority in authorities]
+    db_last_published = dict(
+        Session.query(FHRSAuthority.code, FHRSAuthority.last_published).\
+        filter(FHRSAuthority.code.in_(codes)))
+
     requiring_update = []
     for xml_authority in authorities:
         # if no last published date provided in new data, assume it's
         # newer than what's already in the database
         if not xml_authority.last_published:
             requiring_update.append(xml_authority)
-            break
+            continue
 
-        db_authority = Session.query(FHRSAuthority).get(xml_authority.code)
         # if authority is in database, has a last published date, and
         # this date is newer or same as xml data, don't need to fetch
-        fetch_not_required = (
-            db_authority and db_authority.last_published and
-            db_authority.last_published >= xml_authority.last_published)
-
-        if not fetch_not_required:
+        db_date = db_last_published.get(xml_authority.code)
+        if not db_date or db_date < xml_authority.last_published:
             requiring_update.append(xml_authority)
 
     return requiring_update
@@ -193,31 +274,63 @@ def get_authorities_requiring_fetch(authorities):
 def delete_obsolete_authorities_from_session(authorities):
     """Delete any authorities not in supplied list from session
 
+    Obsolete authorities and their establishments are deleted using one
+    DELETE statement for each table rather than one per object.
+
     Return number of authorities deleted from session
     """
 
-    xml_authority_codes = [authority.code for authority in authorities]
-    db_authorities = Session.query(FHRSAuthority).all()
+    xml_authority_codes = {authority.code for authority in authorities}
+    obsolete = Session.query(FHRSAuthority.code, FHRSAuthority.name).\
+        filter(FHRSAuthority.code.notin_(xml_authority_codes)).\
+        all()
+    if not obsolete:
+        return 0
+
+    for code, name in obsolete:
+        info(f"Deleting obsolete authority '{name}' ({code}) and its " +
+             "establishments")
+    obsolete_codes = [code for code, _ in obsolete]
+
+    # establishments first because of foreign key
+    Session.query(FHRSEstablishment).\
+        filter(FHRSEstablishment.authority_code.in_(obsolete_codes)).\
+        delete(synchronize_session=False)
+    Session.query(FHRSAuthority).\
+        filter(FHRSAuthority.code.in_(obsolete_codes)).\
+        delete(synchronize_session=False)
+
+    return len(obsolete_codes)
+
 
-    num_deleted = 0
-    for db_authority in db_authorities:
-        if db_authority.code not in xml_authority_codes:
-            info(f"Deleting obsolete authority '{db_authority.name}' " +
-                 f"({db_authority.code}) and its establishments")
-            Session.delete(db_authority)
-            num_deleted += 1
+@lru_cache(maxsize=32)
+def check_table_exists(table, bind):
+    """Raise RuntimeError if a table doesn't exist
 
-    return num_deleted
+    The check is only made against the database once for each table and
+    bind (connection or engine) because it is called for every authority
+    during an import. A missing table isn't cached as it raises.
+    """
+
+    if not table.exists(bind=bind):
+        raise RuntimeError(f"Table '{table.name}' doesn't exist")
 
 
-def merge_authorities_with_session(authorities):
+def merge_authorities_with_session(authorities, pending_codes=()):
     """Merge the authorities supplied with the session
 
-    This doesn't commit the session. New authorities will be added to
-    the session and modified authorities will be modified based on
-    primary-key matching.
+    This doesn't commit the session. New authorities will be inserted
+    and modified authorities will be updated based on primary-key
+    matching, using INSERT ... ON CONFLICT DO UPDATE rather than
+    selecting each authority first. Only the columns set from XML are
+    updated, and related establishments are not merged. If more than
+    one authority has the same code, the last one is merged.
 
     authorities (list of FHRSAuthority objects)
+    pending_codes (collection of ints): codes of authorities whose
+        establishments haven't been replaced yet, so their last
+        published dates aren't updated (see
+        set_authority_last_published_in_session)
     """
 
     if (not isinstance(authorities, list) or
@@ -225,63 +338,126 @@ def merge_authorities_with_session(authorities):
         raise TypeError(
             f"Expected a list of FHRSAuthority objects, got {authorities}")
 
-    if not FHRSAuthority.__table__.exists(bind=Session.get_bind()):
-        raise RuntimeError(
-            f"Table '{FHRSAuthority.__tablename__}' doesn't exist")
+    check_table_exists(FHRSAuthority.__table__, Session.get_bind())
 
+    debug(f"Merging {len(authorities)} authorities with session")
+    # keyed by code because ON CONFLICT DO UPDATE can't affect the same
+    # row twice in one statement, so the last duplicate is used
+    rows_by_code = {}
     for authority in authorities:
-        debug(f"Merging {authority} with session")
-        Session.merge(authority)
+        if authority.code in rows_by_code:
+            warning(f"Authority code {authority.code} supplied more " +
+                    "than once, using the last")
+        rows_by_code[authority.code] = {
+            column: getattr(authority, column)
+            for column in MERGED_AUTHORITY_COLUMNS}
+    rows = list(rows_by_code.values())
+    for row in rows:
+        if row["code"] in pending_codes:
+            row["last_published"] = None
+
+    # flush any pending ORM changes first so they happen in order
+    Session.flush()
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        statement = insert(FHRSAuthority.__table__).\
+            values(rows[start:start + INSERT_BATCH_SIZE])
+        set_ = {column: statement.excluded[column]
+                for column in MERGED_AUTHORITY_COLUMNS
+                if column != "code"}
+        if pending_codes:
+            set_["last_published"] = case(
+                [(statement.excluded.code.in_(pending_codes),
+                  FHRSAuthority.__table__.c.last_published)],
+                else_=statement.excluded.last_published)
+        statement = statement.on_conflict_do_update(
+            index_elements=["code"], set_=set_)
+        Session.execute(statement)
+
+
+def set_authority_last_published_in_session(authority):
+    """Store the last published date of an authority in the session
+
+    Used once an authority's establishments have been replaced, so that
+    they're fetched again by a later update if this fails beforehand.
+    This doesn't commit the session.
+
+    authority (FHRSAuthority object)
+    """
+
+    Session.query(FHRSAuthority).\
+        filter(FHRSAuthority.code == authority.code).\
+        update({FHRSAuthority.last_published: authority.last_published},
+               synchronize_session=False)
 
 
 def download_establishments_xml_file(authority): # pragma: no cover
     """Download the establishments XML file for an authority"""
 
     return download_with_retries(
-        authority.xml_url, {"accept": "text/xml"}, "UTF-8")
+        authority.xml_url, {"accept": "text/xml"}, as_bytes=True)
+
+
+def fetch_establishments(authority): # pragma: no cover
+    """Download and parse the establishments XML file for an authority
+
+    Returns list of FHRSEstablishment objects, which aren't added to the
+    session, so this can be called from a worker thread.
+    """
+
+    return parse_xml_establishments(
+        download_establishments_xml_file(authority))
+
 
+def fetch_establishments_for_authorities(authorities,
+                                         max_workers=8): # pragma: no cover
+    """Download and parse establishments for authorities concurrently
 
-def parse_xml_establishments(xml_string):
+    Yields (authority, future) tuples in the order of the authorities
+    supplied, where the future's result() is a list of FHRSEstablishment
+    objects or raises any exception from downloading or parsing. Up to
+    max_workers files are downloaded and parsed in threads ahead of the
+    one being yielded, so that HTTP requests and parsing (much of which
+    is done by lxml without holding the GIL) overlap with each other
+    and with the caller's database work in the main thread, without
+    holding every authority's establishments in memory.
+    """
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for authority in authorities:
+            pending.append((authority, executor.submit(
+                fetch_establishments, authority)))
+            if len(pending) >= max_workers:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+
+def parse_xml_establishments(xml):
     """Parse FHRS establishments XML into FHRSEstablishment objects
 
+    xml (bytes, string or file-like object): establishments XML
+
     Returns list of FHRSEstablishment objects
     """
 
+    establishments = []
     try:
-        root = fromstring(xml_string)
-    except ParseError:
+        for node in iterparse_xml_nodes(xml, "EstablishmentDetail"):
+            establishment = FHRSEstablishment()
+
+            # findtext returns an empty string for an empty element
+            for db_field, tag in ESTABLISHMENT_FIELD_TAGS:
+                setattr(establishment, db_field, node.findtext(tag) or None)
+            establishment.set_location(
+                node.findtext("Geocode/Latitude") or None,
+                node.findtext("Geocode/Longitude") or None)
+
+            establishments.append(establishment)
+    except XMLSyntaxError:
         critical("Error parsing establishments XML file")
         raise
 
-    establishments = []
-    for node in root.iter("EstablishmentDetail"):
-        establishment = FHRSEstablishment()
-
-        # location set using method below
-        mapping = {"fhrs_id": "FHRSID",
-                   "name": "BusinessName",
-                   "postcode_original": "PostCode",
-                   # before address because if an address line contains a
-                   # postcode, the address validator needs to check whether
-                   # postcode already filled
-                   "postcode": "PostCode",
-                   # address in reverse order so that if postcode is in one
-                   # or more address lines, latest postcode line is used
-                   "address_4": "AddressLine4",
-                   "address_3": "AddressLine3",
-                   "address_2": "AddressLine2",
-                   "address_1": "AddressLine1",
-                   "rating_date": "RatingDate",
-                   "authority_code": "LocalAuthorityCode"}
-        for db_field, xml_field in mapping.items():
-            setattr(establishment, db_field,
-                    get_xml_field(node, xml_field))
-        establishment.set_location(
-            get_xml_field(node, "Geocode/Latitude"),
-            get_xml_field(node, "Geocode/Longitude"))
-
-        establishments.append(establishment)
-
     return establishments
 
 
@@ -305,29 +481,43 @@ def replace_establishments_for_authority_in_session(authority, establishments):
             "Second argument should be a list of FHRSEstablishment objects, " +
             f"got {establishments}")
 
-    if not FHRSEstablishment.__table__.exists(bind=Session.get_bind()):
-        raise RuntimeError(
-            f"Table '{FHRSEstablishment.__tablename__}' doesn't exist")
+    check_table_exists(FHRSEstablishment.__table__, Session.get_bind())
 
-    # delete establishments for this authority
+    # delete establishments for this authority, without evaluating the
+    # criteria against every object in the session because they're
+    # inserted below with Core rather than loaded as ORM objects
     Session.query(FHRSEstablishment).\
         filter(FHRSEstablishment.authority_code == authority.code).\
-        delete()
+        delete(synchronize_session=False)
 
-    # add establishments
-    for establishment in establishments:
+    # find any establishments with the same FHRS IDs (in other
+    # authorities) in a single query rather than one per establishment
+    fhrs_ids = [establishment.fhrs_id for establishment in establishments]
+    existing_authority_names = dict(
+        Session.query(FHRSEstablishment.fhrs_id, FHRSAuthority.name).\
+        join(FHRSAuthority).\
+        filter(FHRSEstablishment.fhrs_id.in_(fhrs_ids)))
 
-        fetched = Session.query(FHRSEstablishment).get(establishment.fhrs_id)
-        if fetched:
-            # cannot just add it and handle any exception because
-            # exception only raised on commit
+    rows = []
+    for establishment in establishments:
+        fhrs_id = establishment.fhrs_id
+        if fhrs_id in existing_authority_names:
+            # cannot just insert it and handle any exception because
+            # that would abort the whole transaction
             warning(
                 f"Could not add establishment '{establishment.name}' in "
                 f"authority '{authority.name}' because there is already one " +
-                f"with the same FHRS ID ({establishment.fhrs_id}) in " +
-                f"authority '{fetched.authority.name}'")
-        else:
-            Session.add(establishment)
+                f"with the same FHRS ID ({fhrs_id}) in " +
+                f"authority '{existing_authority_names[fhrs_id]}'")
+            continue
+        existing_authority_names[fhrs_id] = authority.name
+        rows.append({column: getattr(establishment, column)
+                     for column in ESTABLISHMENT_COLUMNS})
+
+    # executemany with Core rather than adding ORM objects to session
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        Session.execute(FHRSEstablishment.__table__.insert(),
+                        rows[start:start + INSERT_BATCH_SIZE])
 
 
 def add_authority_districts_in_session():
@@ -345,31 +535,119 @@ def add_authority_districts_in_session():
     Session.query(FHRSAuthority).\
         update({FHRSAuthority.district_code: None})
 
+    # count each authority's establishments in each district using one
+    # spatial join rather than a query per authority. Only establishments
+    # with a location within a district are counted, and a number of
+    # establishments in East Renfrewshire have a PRIVATE postcode and a
+    # location far away in Chelmsford, so these are excluded.
+    district_counts = Session.query(
+        FHRSEstablishment.authority_code, LocalAuthorityDistrict.code,
+        LocalAuthorityDistrict.name, func.count()).\
+        join(LocalAuthorityDistrict,
+             ST_Intersects(FHRSEstablishment.location,
+                           LocalAuthorityDistrict.boundary)).\
+        filter(or_(FHRSEstablishment.postcode_original != "PRIVATE",
+                   FHRSEstablishment.postcode_original.is_(None))).\
+        group_by(FHRSEstablishment.authority_code,
+                 LocalAuthorityDistrict.code)
+    counts_by_authority = defaultdict(dict)
+    for authority_code, district_code, district_name, count \
+            in district_counts:
+        counts_by_authority[authority_code][(district_code, district_name)] \
+            = count
+
     # iterate authorities in order of number of establishments because
     # there are some small authorities that shouldn't be associated with
     # a district
-    query = Session.query(FHRSAuthority).\
+    authorities = Session.query(FHRSAuthority.code, FHRSAuthority.name).\
         join(FHRSEstablishment).\
-        group_by(FHRSAuthority).\
+        group_by(FHRSAuthority.code).\
         order_by(desc(func.count(FHRSEstablishment.fhrs_id)))
 
-    for authority in query:
-        district = authority.get_local_authority_district()
+    # key: district code, value: name of authority associated with it
+    associated = {}
+    rows = []
+    for code, name in authorities:
+        district = get_top_district(counts_by_authority[code])
 
-        if district and not district.fhrs_authority:
+        if district and district[0] not in associated:
             debug("Setting local authority district for FHRS authority " +
-                  f"{authority.name} to {district.name}")
-            authority.district = district
-            Session.add(authority)
+                  f"{name} to {district[1]}")
+            associated[district[0]] = name
+            rows.append({"authority": code, "district": district[0]})
             continue
 
-        if district and district.fhrs_authority:
-            error(f"District '{district.name}' for authority " +
-                  f"'{authority.name}' already associated with FHRS " +
-                  f"authority '{district.fhrs_authority.name}'")
+        if district:
+            error(f"District '{district[1]}' for authority '{name}' " +
+                  "already associated with FHRS authority " +
+                  f"'{associated[district[0]]}'")
             # carry on and show next error message
 
         # should only affect statistics, so don't raise an exception
         # that would stop updated FHRS data from being committed
         error("Could not set a local authority district for FHRS " +
-              f"authority {authority.name}")
+              f"authority {name}")
+
+    if rows:
+        table = FHRSAuthority.__table__
+        Session.execute(
+            table.update().\
+            where(table.c.code == bindparam("authority")).\
+            values(district_code=bindparam("district")),
+            rows)
+
+
+def get_top_district(counts):
+    """Return district containing most of an authority's establishments
+
+    counts (dict): counts of the authority's establishments, with
+    (district code, district name) tuples as keys
+
+    Returns the (code, name) tuple for the district if the proportion of
+    establishments in it exceeds DISTRICT_PROPORTION_THRESHOLD,
+    otherwise None. This is preferable to finding the district in which
+    the centroid of the establishments falls, because the centroid can
+    fall outside the district depending on the shape of its boundary.
+    """
+    if not counts:
+        return None
+    top_district = max(counts, key=counts.get)
+    proportion = counts[top_district] / sum(counts.values())
+    if proportion > DISTRICT_PROPORTION_THRESHOLD:
+        return top_district
+    return None
+
+
+def update_mapping_distances_in_session():
+    """Store distance between each mapped OSM object and establishment
+
+    Distances are stored in the mapping table rather than calculated
+    whenever they're selected. They're first calculated by the OSM
+    import (import/osm/post_import.sql), using the establishments at the
+    time, so this should be run after replacing establishments because
+    their locations may have changed. This doesn't commit the session.
+    """
+
+    # outer join so mappings whose establishment has been removed get
+    # NULL in the same UPDATE ... FROM rather than a separate pass
+    mapping = aliased(OSMFHRSMapping)
+    distances = Session.query(
+        mapping.osm_id_single_space, mapping.fhrs_id,
+        ST_Distance(OSMObject.location,
+                    FHRSEstablishment.location).label("distance"),
+        not_(ST_DWithin(OSMObject.location, FHRSEstablishment.location,
+                        DISTANT_THRESHOLD_METRES,
+                        use_spheroid=False)).label("distant")).\
+        join(OSMObject, OSMObject.osm_id_single_space ==
+             mapping.osm_id_single_space).\
+        outerjoin(FHRSEstablishment,
+                  FHRSEstablishment.fhrs_id == mapping.fhrs_id).\
+        subquery()
+
+    Session.query(OSMFHRSMapping).\
+        filter(OSMFHRSMapping.osm_id_single_space ==
+               distances.c.osm_id_single_space,
+               OSMFHRSMapping.fhrs_id == distances.c.fhrs_id).\
+        update({OSMFHRSMapping.distance: distances.c.distance,
+                OSMFHRSMapping.distant: distances.c.distant},
+               synchronize_session=False)
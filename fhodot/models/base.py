@@ -3,6 +3,65 @@
 Separate module to avoid circular imports.
 """
 
+from logging import info
+
+from sqlalchemy import DDL, inspect
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.schema import CreateColumn
 
 DeclarativeBase = declarative_base()
+
+
+def add_missing_columns(bind):
+    """Add any columns in the models that are missing from existing tables
+
+    create_all only creates tables that don't exist, so columns added to
+    a model later (e.g. generated columns, which are also created by
+    import/osm/post_import.sql) would otherwise be missing from existing
+    databases until the table is recreated. Each column is added using
+    DDL compiled from the model, so generated columns are calculated for
+    existing rows. Models must be imported first (e.g. fhodot.models).
+
+    bind: engine or connection
+    """
+
+    inspector = inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+    for table in DeclarativeBase.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        existing_columns = {column["name"]
+                            for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            info(f"Adding column {column.name} to table {table.name}")
+            column_ddl = CreateColumn(column).compile(dialect=bind.dialect)
+            bind.execute(DDL(f"ALTER TABLE {table.name} ADD COLUMN " +
+                             f"IF NOT EXISTS {column_ddl}"))
+
+
+def add_missing_indexes(bind):
+    """Create any indexes in the models that are missing from existing tables
+
+    As for add_missing_columns, which should be run first so that the
+    indexed columns exist (e.g. the partial index on
+    osm_fhrs_mapping.distant).
+
+    bind: engine or connection
+    """
+
+    inspector = inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+    for table in DeclarativeBase.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        existing_indexes = {index["name"]
+                            for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            info(f"Creating index {index.name} on table {table.name}")
+            index.create(bind=bind)
@@ -6,17 +6,17 @@ null.
 """
 
 from datetime import datetime, timedelta
+from functools import lru_cache
 from logging import warning
-from re import fullmatch, sub
+from re import compile as re_compile
 
 from geoalchemy2 import Geography, Geometry
 from geoalchemy2.functions import ST_X, ST_Y
-from sqlalchemy import (cast, Column, Date, DateTime, ForeignKey, Integer, or_,
-                        String, Text)
+from sqlalchemy import (cast, Column, Date, DateTime, ForeignKey, func,
+                        Integer, not_, select, String, Text)
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import column_property, joinedload, relationship, validates
+from sqlalchemy.orm import column_property, relationship, validates
 
-from fhodot.database import Session
 from fhodot.models.base import DeclarativeBase
 
 
@@ -27,6 +27,13 @@ from fhodot.models.base import DeclarativeBase
 #   letter O instead of zero (common error) converted later
 POSTCODE_PATTERN = r"^([A-Z]{1,2}[0-9][A-Z0-9]?)( ?[O0-9]([A-Z]{2})?)?$"
 
+# used by the establishment and authority validators below and by
+# standardise_postcode
+POSTCODE_REGEX = re_compile(POSTCODE_PATTERN)
+FRACTIONAL_SECONDS_REGEX = re_compile(r"\.\d{0,3}$")
+EMAIL_REGEX = re_compile(r"^\S+@\S+\.\S+$")
+XML_URL_REGEX = re_compile(r"^https*://.*\.gov\.uk/.*\.xml$")
+
 
 class FHRSEstablishment(DeclarativeBase):
     """A Food Hygience Rating Scheme establishment
@@ -67,7 +74,9 @@ class FHRSEstablishment(DeclarativeBase):
                      "LocalAuthorityDistrict.boundary).as_comparison(1, 2)"),
         back_populates="fhrs_establishments",
         sync_backref=False,
-        viewonly=True)
+        viewonly=True,
+        # one ST_Intersects query per object, so raise rather than lazy load
+        lazy="raise")
 
 
     def __repr__(self):
@@ -86,15 +95,18 @@ class FHRSEstablishment(DeclarativeBase):
     @hybrid_property
     def num_matches_same_postcodes(self):
         """Return number of matched OSM objects with same postcode"""
-        return [mapping.postcodes_match
-                for mapping in self.osm_mappings].count(True)
+        return sum(1 for mapping in self.osm_mappings
+                   if mapping.postcodes_match is True)
 
 
     @num_matches_same_postcodes.expression
     def num_matches_same_postcodes(self):
-        """Not implemented at expression level"""
-        raise NotImplementedError(
-            "num_matches_same_postcodes not implemented at expression level")
+        """Return correlated subquery counting matches with same postcode
+
+        Allows the count to be selected or filtered on in SQL rather than
+        loading each establishment's mappings and OSM objects.
+        """
+        return self.get_num_matches_subquery(same_postcodes=True)
 
 
     @hybrid_property
@@ -105,15 +117,40 @@ class FHRSEstablishment(DeclarativeBase):
         FHRS postcodes are different (including if a postcode is missing
         on either but not both sides)
         """
-        return [mapping.postcodes_match
-                for mapping in self.osm_mappings].count(False)
+        return sum(1 for mapping in self.osm_mappings
+                   if mapping.postcodes_match is False)
 
 
     @num_matches_different_postcodes.expression
     def num_matches_different_postcodes(self):
-        """Not implemented at expression level"""
-        raise NotImplementedError("num_matches_different_postcodes not " +
-                                  "implemented at expression level")
+        """Return correlated subquery counting matches with different
+        postcode
+        """
+        return self.get_num_matches_subquery(same_postcodes=False)
+
+
+    @classmethod
+    def get_num_matches_subquery(cls, same_postcodes):
+        """Return correlated subquery counting matched OSM objects
+
+        same_postcodes (bool): count OSM objects with the same postcode
+            if True, or with a different postcode if False
+        """
+
+        # classes found via relationships to avoid a circular import
+        mapping_class = cls.osm_mappings.property.mapper.class_
+        osm_class = mapping_class.osm_object.property.mapper.class_
+
+        # comparisons with a null postcode are null rather than False
+        postcodes_match = func.coalesce(mapping_class.postcodes_match, False)
+        return select([func.count()]).\
+            where(mapping_class.fhrs_id == cls.fhrs_id).\
+            where(mapping_class.osm_id_single_space ==
+                  osm_class.osm_id_single_space).\
+            where(postcodes_match if same_postcodes
+                  else not_(postcodes_match)).\
+            correlate(cls).\
+            as_scalar()
 
 
     @validates("fhrs_id", "authority_code")
@@ -153,7 +190,7 @@ class FHRSEstablishment(DeclarativeBase):
             return value
 
         assert isinstance(value, str)
-        match = fullmatch(POSTCODE_PATTERN, value)
+        match = POSTCODE_REGEX.fullmatch(value)
         # valid postcode including second part
         if match and match.group(2) and not self.postcode:
             msg = f"Moving {value} from {column} to postcode"
@@ -174,28 +211,12 @@ class FHRSEstablishment(DeclarativeBase):
             return value
 
         assert isinstance(value, str)
-        value = value.strip().upper()
-        if not value: # if (now) blank string
-            return None
-
-        # replace any (inner) whitespace with a single space
-        value = sub(r"\s+", " ", value)
-
-        match = fullmatch(POSTCODE_PATTERN, value)
-        if not match:
-            warning(f"Postcode {value} invalid: not storing")
-            return None
-
-        first_part, second_part = match.group(1, 2) # 0 is full match
-        assert first_part # not blank
-
-        if not second_part:
-            return first_part
-
-        # replace letter O at start of 2nd part with zero (common error)
-        # to ensure space between parts, take out then add back in
-        second_part = sub("^O", "0", second_part.lstrip())
-        return f"{first_part} {second_part}"
+        postcode = standardise_postcode(value)
+        # logged here rather than in the memoised function so that every
+        # invalid postcode is logged, not just the first of each
+        if postcode is None and value.strip():
+            warning(f"Postcode {value.strip().upper()} invalid: not storing")
+        return postcode
 
 
 class FHRSAuthority(DeclarativeBase):
@@ -233,47 +254,6 @@ class FHRSAuthority(DeclarativeBase):
         return f"<FHRSAuthority: {self.name} ({self.code})>"
 
 
-    def get_local_authority_district(self):
-        """Returns the LocalAuthorityDistrict for this authority
-
-        Calculates this geographically by finding the district boundary
-        within which most of this authority's establishments are found.
-        This may not work if there isn't a 1:1 relationship between FHRS
-        authorities and Local Authority Districts.
-        """
-
-        # This method is preferable to finding the district in which the
-        # centroid of the establishments falls because sometimes this
-        # centroid can fall outside the district depending on the shape
-        # of its boundary.
-
-        query = Session.query(FHRSEstablishment).\
-            filter(
-                FHRSEstablishment.authority_code == self.code,
-                # a number of establishments in East Renfrewshire have
-                # this postcode and location far away in Chelmsford
-                or_(FHRSEstablishment.postcode_original != "PRIVATE",
-                    FHRSEstablishment.postcode_original.is_(None))).\
-            options(
-                # fhrs_authority used by add_authority_districts_in_session
-                joinedload("district").joinedload("fhrs_authority"))
-
-        # only use establishments that have a location set and are
-        # within a district
-        districts = [est.district for est in query if est.district]
-        if not districts:
-            return None # avoid ValueError in max() below
-        counts = {dist:districts.count(dist) for dist in districts}
-        top_district = max(counts, key=counts.get)
-        proportion = counts[top_district] / sum(counts.values())
-
-        # if 90% or more of the authority's establishments are in the
-        # top district, assume that they are associated
-        if proportion > 0.9:
-            return top_district
-        return None
-
-
     def set_last_published_from_string(self, string):
         """Set last_published from string as obtained from FHRS API
 
@@ -289,7 +269,7 @@ class FHRSAuthority(DeclarativeBase):
 
         # format example: 2020-06-30T00:30:51.223
         # remove trailing full stop and up to 3 digits
-        string = sub(r"\.\d{0,3}$", "", string)
+        string = FRACTIONAL_SECONDS_REGEX.sub("", string)
         try:
             self.last_published = datetime.strptime(
                 string, "%Y-%m-%dT%H:%M:%S")
@@ -349,7 +329,7 @@ class FHRSAuthority(DeclarativeBase):
         # remove any whitespace
         value = value.strip()
         # an overly simple regex check
-        if fullmatch(r"^\S+@\S+\.\S+$", value):
+        if EMAIL_REGEX.fullmatch(value):
             return value
 
         warning(f"Email address '{value}' of authority '{self.name}' " +
@@ -369,7 +349,7 @@ class FHRSAuthority(DeclarativeBase):
             # remove any whitespace
             value = value.strip()
             # an overly simple regex check
-            if fullmatch(r"^https*://.*\.gov\.uk/.*\.xml$", value):
+            if XML_URL_REGEX.fullmatch(value):
                 return value
 
         raise ValueError(
@@ -403,3 +383,38 @@ def validate_positive_integer(column, value):
             f"{column} value {value} should be between 0 and 2147483647")
 
     return value
+
+
+# the same postcodes are validated repeatedly for establishments at the
+# same address, so memoise results (bounded to limit memory use)
+@lru_cache(maxsize=65536)
+def standardise_postcode(value):
+    """Standardise a postcode string, returning None if blank or invalid
+
+    Converts to upper case, normalises whitespace and replaces letter O
+    at the start of the second part with zero.
+    """
+
+    value = value.strip().upper()
+    if not value: # if (now) blank string
+        return None
+
+    # replace any (inner) whitespace with a single space
+    value = " ".join(value.split())
+
+    match = POSTCODE_REGEX.fullmatch(value)
+    if not match:
+        return None
+
+    first_part, second_part = match.group(1, 2) # 0 is full match
+    assert first_part # not blank
+
+    if not second_part:
+        return first_part
+
+    # replace letter O at start of 2nd part with zero (common error)
+    # to ensure space between parts, take out then add back in
+    second_part = second_part.lstrip()
+    if second_part.startswith("O"):
+        second_part = "0" + second_part[1:]
+    return f"{first_part} {second_part}"
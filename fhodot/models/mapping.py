@@ -7,17 +7,23 @@ structure in order to allow easier creation of test cases. See also the
 Imposm mapping YAML file.
 """
 
-from geoalchemy2.functions import ST_Distance, ST_DWithin
-from sqlalchemy import (
-    and_, BigInteger, Column, ForeignKey, Integer, not_, or_, select)
+from sqlalchemy import (BigInteger, Boolean, Column, Float, ForeignKey, Index,
+                        Integer, or_, text)
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import column_property, relationship
+from sqlalchemy.orm import deferred, relationship
 
 from fhodot.models.base import DeclarativeBase
 from fhodot.models.fhrs import FHRSEstablishment
 from fhodot.models.osm import OSMObject
 
 
+# In analysis of existing matches, 95th percentile distance was 238m so
+# a mapping with a distance of 250m or more between OSMObject and
+# FHRSEstablishment is considered distant (also used in
+# import/osm/post_import.sql)
+DISTANT_THRESHOLD_METRES = 250
+
+
 class OSMFHRSMapping(DeclarativeBase):
     """A unique mapping between an OSMObject and an FHRSEstablishment
 
@@ -27,6 +33,13 @@ class OSMFHRSMapping(DeclarativeBase):
     """
 
     __tablename__ = "osm_fhrs_mapping"
+    # same indexes as created by post_import.sql, used when checking
+    # whether an FHRS establishment has any mappings and when finding
+    # OSM objects with distant matches
+    __table_args__ = (
+        Index("idx_osm_fhrs_mapping_fhrs_id", "fhrs_id"),
+        Index("idx_osm_fhrs_mapping_distant", "osm_id_single_space",
+              postgresql_where=text("distant")))
 
     osm_id_single_space = Column(BigInteger,
                                  ForeignKey("osm.osm_id_single_space"),
@@ -40,23 +53,11 @@ class OSMFHRSMapping(DeclarativeBase):
         primaryjoin=("OSMFHRSMapping.fhrs_id == " +
                      "foreign(FHRSEstablishment.fhrs_id)"))
 
-    # In analysis of existing matches, 95th percentile distance was 238m
-    # so a mapping with a distance of 250m or more between OSMObject and
-    # FHRSEstablishment is considered distant
-    distant = column_property(
-        select([not_(ST_DWithin(OSMObject.location, FHRSEstablishment.location,
-                                250, use_spheroid=False))]).\
-        where(and_(OSMObject.osm_id_single_space == osm_id_single_space,
-                   FHRSEstablishment.fhrs_id == fhrs_id)),
-        deferred=True # to prevent slowing queries where not required
-    )
-
-    distance = column_property(
-        select([ST_Distance(OSMObject.location, FHRSEstablishment.location)]).\
-        where(and_(OSMObject.osm_id_single_space == osm_id_single_space,
-                   FHRSEstablishment.fhrs_id == fhrs_id)),
-        deferred=True # to prevent slowing queries where not required
-    )
+    # stored by import/osm/post_import.sql and refreshed by
+    # fhodot.fetch_fhrs.update_mapping_distances_in_session rather than
+    # calculated whenever they're selected
+    distance = deferred(Column(Float))
+    distant = deferred(Column(Boolean))
 
 
     def __repr__(self):
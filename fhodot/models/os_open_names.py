@@ -1,8 +1,7 @@
 """SQLAlchemy database models for Ordnance Survey Open Names"""
 
-from sqlalchemy import Column, func, Index, String
+from sqlalchemy import Column, Computed, Index, String
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import column_property
 
 from fhodot.models.base import DeclarativeBase
 
@@ -24,12 +23,10 @@ class OSOpenNamesObject:
     name_2_lang = Column(String(3))
     name_2_std = Column(String)
     postcode_district = Column(String(4))
-
-    @declared_attr
-    def postcode_area(cls): # pylint:disable=no-self-argument
-        """Return leading letter(s) from postcode_district"""
-        return column_property(
-            func.substring(cls.postcode_district, "^[A-Z]+"))
+    # leading letter(s) from postcode_district, stored when imported
+    # rather than extracted for every row filtered on
+    postcode_area = Column(String(2), Computed(
+        "substring(postcode_district from '^[A-Z]+')", persisted=True))
 
     @declared_attr
     def __table_args__(cls): # pylint:disable=no-self-argument
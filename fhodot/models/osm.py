@@ -7,11 +7,11 @@ structure in order to allow easier creation of test cases. See also the
 Imposm mapping YAML file.
 """
 
-from geoalchemy2 import Geography, Geometry
-from geoalchemy2.functions import ST_X, ST_Y
-from sqlalchemy import BigInteger, case, cast, Column, or_, String
+from geoalchemy2 import Geography
+from sqlalchemy import (BigInteger, Boolean, Column, Computed, Float, func,
+                        not_, select, String)
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import column_property, relationship
+from sqlalchemy.orm import relationship
 
 from fhodot.models.base import DeclarativeBase
 
@@ -23,21 +23,30 @@ class OSMObject(DeclarativeBase):
 
     osm_id_single_space = Column(BigInteger, primary_key=True,
                                  autoincrement=False)
-    osm_id_by_type = column_property(cast(case(
-        [(osm_id_single_space <= -1e17, 0 - osm_id_single_space - 1e17),
-         (osm_id_single_space < 0, 0 - osm_id_single_space)],
-        else_=osm_id_single_space), BigInteger))
-    osm_type = column_property(case(
-        [(osm_id_single_space <= -1e17, "relation"),
-         (osm_id_single_space < 0, "way")],
-        else_="node"))
+    # generated columns stored when imported (see post_import.sql)
+    # rather than computed for every row selected
+    osm_id_by_type = Column(BigInteger, Computed(
+        "CASE " +
+        "WHEN osm_id_single_space <= -100000000000000000 " +
+        "THEN -osm_id_single_space - 100000000000000000 " +
+        "WHEN osm_id_single_space < 0 THEN -osm_id_single_space " +
+        "ELSE osm_id_single_space END",
+        persisted=True))
+    osm_type = Column(String(8), Computed(
+        "CASE " +
+        "WHEN osm_id_single_space <= -100000000000000000 THEN 'relation' " +
+        "WHEN osm_id_single_space < 0 THEN 'way' " +
+        "ELSE 'node' END",
+        persisted=True))
     location = Column(Geography)
-    lat = column_property(ST_Y(cast(location, Geometry)))
-    lon = column_property(ST_X(cast(location, Geometry)))
+    # stored so that coordinates aren't calculated for every row selected
+    lat = Column(Float, Computed("ST_Y(location::geometry)", persisted=True))
+    lon = Column(Float, Computed("ST_X(location::geometry)", persisted=True))
     fhrs_ids_string = Column(String)
-    fhrs_ids_string_valid = column_property(
-        or_(fhrs_ids_string == "",
-            fhrs_ids_string.op("~")("^[0-9]+(;[0-9]+)*$")))
+    # stored rather than matching the regex for every row selected
+    fhrs_ids_string_valid = Column(Boolean, Computed(
+        "fhrs_ids_string = '' OR fhrs_ids_string ~ '^[0-9]+(;[0-9]+)*$'",
+        persisted=True))
     name = Column(String)
     addr_postcode = Column(String)
     not_addr_postcode = Column(String)
@@ -49,7 +58,9 @@ class OSMObject(DeclarativeBase):
                      "LocalAuthorityDistrict.boundary).as_comparison(1, 2)"),
         back_populates="osm_objects",
         sync_backref=False,
-        viewonly=True)
+        viewonly=True,
+        # one ST_Intersects query per object, so raise rather than lazy load
+        lazy="raise")
 
 
     def __repr__(self):
@@ -59,15 +70,18 @@ class OSMObject(DeclarativeBase):
     @hybrid_property
     def num_matches_same_postcodes(self):
         """Return number of matched establishments with same postcode"""
-        return [mapping.postcodes_match
-                for mapping in self.fhrs_mappings].count(True)
+        return sum(1 for mapping in self.fhrs_mappings
+                   if mapping.postcodes_match is True)
 
 
     @num_matches_same_postcodes.expression
     def num_matches_same_postcodes(self):
-        """Not implemented at expression level"""
-        raise NotImplementedError(
-            "num_matches_same_postcodes not implemented at expression level")
+        """Return correlated subquery counting matches with same postcode
+
+        Allows the count to be selected or filtered on in SQL rather than
+        loading each object's mappings and FHRS establishments.
+        """
+        return self.get_num_matches_subquery(same_postcodes=True)
 
 
     @hybrid_property
@@ -78,22 +92,48 @@ class OSMObject(DeclarativeBase):
         and FHRS postcodes are different (including if a postcode is
         missing on either but not both sides)
         """
-        return [mapping.postcodes_match
-                for mapping in self.fhrs_mappings].count(False)
+        return sum(1 for mapping in self.fhrs_mappings
+                   if mapping.postcodes_match is False)
 
 
     @num_matches_different_postcodes.expression
     def num_matches_different_postcodes(self):
-        """Not implemented at expression level"""
-        raise NotImplementedError("num_matches_different_postcodes not " +
-                                  "implemented at expression level")
+        """Return correlated subquery counting matches with different
+        postcode
+        """
+        return self.get_num_matches_subquery(same_postcodes=False)
+
+
+    @classmethod
+    def get_num_matches_subquery(cls, same_postcodes):
+        """Return correlated subquery counting matched establishments
+
+        same_postcodes (bool): count establishments with the same postcode
+            if True, or with a different postcode if False. FHRS IDs that
+            don't match an establishment aren't counted either way.
+        """
+
+        # classes found via relationships to avoid a circular import
+        mapping_class = cls.fhrs_mappings.property.mapper.class_
+        fhrs_class = mapping_class.fhrs_establishment.property.mapper.class_
+
+        # comparisons with a null postcode are null rather than False
+        postcodes_match = func.coalesce(mapping_class.postcodes_match, False)
+        return select([func.count()]).\
+            where(mapping_class.osm_id_single_space ==
+                  cls.osm_id_single_space).\
+            where(mapping_class.fhrs_id == fhrs_class.fhrs_id).\
+            where(postcodes_match if same_postcodes
+                  else not_(postcodes_match)).\
+            correlate(cls).\
+            as_scalar()
 
 
     @hybrid_property
     def num_mismatched_fhrs_ids(self):
         """Return number of FHRS IDs that don't match an establishment"""
-        return [mapping.fhrs_establishment
-                for mapping in self.fhrs_mappings].count(None)
+        return sum(1 for mapping in self.fhrs_mappings
+                   if mapping.fhrs_establishment is None)
 
 
     @num_mismatched_fhrs_ids.expression
@@ -1,51 +1,146 @@
 """Functions for importing OS Open Names data"""
 
-from csv import DictReader
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from csv import DictWriter, QUOTE_ALL, reader
+from io import StringIO
+from logging import info
+from multiprocessing import get_context
+from os import cpu_count
+from os.path import basename
 
 from fhodot.database import Session
 from fhodot.models import OSOpenNamesObject, OSPlace, OSRoad
 from fhodot.standardise import standardise
 
 
-def add_os_object_to_session(os_class, row):
-    """Add OSPlace or OSRoad to database session using data from row"""
+def get_os_object_row(os_class, row, columns):
+    """Return OSPlace or OSRoad column values from CSV row as a dict
+
+    columns: dict of CSV header names and their indexes in row
+    """
 
     assert issubclass(os_class, OSOpenNamesObject)
 
     # Standardised names stored directly in database rather than using
     # column_property; it's not possible to use the (non-immutable)
     # Postgres 'unaccent' function within an index.
-    os_object = os_class(os_id=row["ID"],
-                         name_1=row["NAME1"],
-                         name_1_lang=row["NAME1_LANG"],
-                         name_1_std=standardise(row["NAME1"]),
-                         name_2=row["NAME2"],
-                         name_2_lang=row["NAME2_LANG"],
-                         name_2_std=standardise(row["NAME2"]),
-                         postcode_district=row["POSTCODE_DISTRICT"])
+    name_1 = row[columns["NAME1"]]
+    name_2 = row[columns["NAME2"]]
+    os_object_row = {"os_id": row[columns["ID"]],
+                     "name_1": name_1,
+                     "name_1_lang": row[columns["NAME1_LANG"]],
+                     "name_1_std": standardise(name_1),
+                     "name_2": name_2,
+                     "name_2_lang": row[columns["NAME2_LANG"]],
+                     "name_2_std": standardise(name_2),
+                     "postcode_district": row[columns["POSTCODE_DISTRICT"]]}
     if os_class == OSPlace:
-        os_object.place_type = row["LOCAL_TYPE"]
+        os_object_row["place_type"] = row[columns["LOCAL_TYPE"]]
+
+    return os_object_row
+
+
+def get_os_class(row, columns):
+    """Return OSPlace or OSRoad if row represents populated place or
+    named road, None otherwise
+
+    columns: dict of CSV header names and their indexes in row
+    """
+
+    row_type = row[columns["TYPE"]]
+    if row_type == "populatedPlace":
+        return OSPlace
+
+    if (row_type == "transportNetwork" and
+            row[columns["LOCAL_TYPE"]] == "Named Road"):
+        return OSRoad
+
+    return None
+
+
+def insert_os_objects_in_session(os_class, rows):
+    """Insert rows of OSPlace or OSRoad column values in session
+
+    Rows are written to an in-memory CSV file and loaded with a single
+    PostgreSQL COPY on the session's connection, rather than adding an
+    ORM object to the session or executing an INSERT for each row. This
+    doesn't commit the session.
+    """
 
-    Session.add(os_object)
+    if not rows:
+        return
 
+    columns = list(rows[0].keys())
+    data = StringIO()
+    # quote all values so that empty strings aren't loaded as nulls
+    DictWriter(data, fieldnames=columns, quoting=QUOTE_ALL).writerows(rows)
+    data.seek(0)
 
-def process_row(row):
-    """If row represents populated place or named road, add to database"""
+    with Session.connection().connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {os_class.__tablename__} ({', '.join(columns)}) " +
+            "FROM STDIN WITH (FORMAT csv)",
+            data)
 
-    if row["TYPE"] == "populatedPlace":
-        add_os_object_to_session(OSPlace, row)
 
-    elif (row["TYPE"] == "transportNetwork" and
-          row["LOCAL_TYPE"] == "Named Road"):
-        add_os_object_to_session(OSRoad, row)
+def read_csv(file_path, headers):
+    """Return relevant rows from a single OS CSV file
 
+    Returns a dict with OSPlace and OSRoad as keys and lists of column
+    values as values. This doesn't use the database, so that files can
+    be read by worker processes.
+    """
 
-def import_csv(file_path, headers):
-    """Filter a single OS CSV file and store relevant objects"""
+    rows = {OSPlace: [], OSRoad: []}
+    # index rows by position rather than creating a dict for each row
+    columns = {name: index for index, name in enumerate(headers)}
 
     with open(file_path, "r", encoding="utf-8-sig") as data_file:
-        for row in DictReader(data_file,
-                              fieldnames=headers,
-                              delimiter=",",
-                              quotechar='"'):
-            process_row(row)
+        for row in reader(data_file, delimiter=",", quotechar='"'):
+            os_class = get_os_class(row, columns)
+            if os_class is not None:
+                rows[os_class].append(
+                    get_os_object_row(os_class, row, columns))
+
+    return rows
+
+
+def insert_csv_rows_in_session(file_path, future):
+    """Insert rows read from an OS CSV file by a worker process
+
+    future: result() is a dict returned by read_csv
+    """
+
+    info(f"Inserting rows from {basename(file_path)}")
+    for os_class, rows in future.result().items():
+        insert_os_objects_in_session(os_class, rows)
+
+
+def import_csv_files(file_paths, headers, max_workers=None):
+    """Filter OS CSV files and store relevant objects
+
+    Files are read and standardised in parallel by a pool of worker
+    processes (one per CPU by default) while the main process inserts
+    each file's rows, so that there is only one writer to the database.
+    Up to max_workers files are read ahead of the one being inserted,
+    rather than holding every file's rows in memory. Workers are
+    spawned rather than forked so that they don't inherit the session's
+    open database connection, so the calling script's main module must
+    be guarded by if __name__ == "__main__". This doesn't commit the
+    session.
+    """
+
+    if max_workers is None:
+        max_workers = cpu_count() or 1
+
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=get_context("spawn")) as executor:
+        pending = deque()
+        for file_path in file_paths:
+            pending.append((file_path, executor.submit(
+                read_csv, file_path, headers)))
+            if len(pending) > max_workers:
+                insert_csv_rows_in_session(*pending.popleft())
+        while pending:
+            insert_csv_rows_in_session(*pending.popleft())
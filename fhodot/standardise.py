@@ -1,11 +1,24 @@
 """Shared standardisation function"""
 
 
-from re import sub
+from functools import lru_cache
+from re import compile as re_compile
 
 from unidecode import unidecode
 
 
+# characters converted to a space, using str.translate rather than a
+# regex substitution
+PUNCTUATION_TO_SPACE_TABLE = str.maketrans("./-", "   ")
+# applied by standardise after punctuation is translated to spaces
+AND_REGEX = re_compile(r" ?[&+] ?")
+EXTRANEOUS_REGEX = re_compile(r"[^a-z\s]")
+WHITESPACE_REGEX = re_compile(r"\s+")
+
+
+# the same place/street names are standardised repeatedly when parsing
+# addresses, so memoise results
+@lru_cache(maxsize=65536)
 def standardise(string):
     """Standardise a place/street name string to allow comparison
 
@@ -13,14 +26,17 @@ def standardise(string):
     which is intended for standardising establishment names for improved
     fuzzy matching
     """
-    string = unidecode(string) # unaccent
+    # unaccent, skipping unidecode for the majority of strings that are
+    # already ASCII
+    if not string.isascii():
+        string = unidecode(string)
     string = string.lower()
     # convert various characters to something specific
-    string = sub("[./-]", " ", string)
-    string = sub(r" ?& ?| ?\+ ?", " and ", string)
+    string = string.translate(PUNCTUATION_TO_SPACE_TABLE)
+    string = AND_REGEX.sub(" and ", string)
     # remove any extraneous characters
-    string = sub(r"[^a-z\s]", "", string)
+    string = EXTRANEOUS_REGEX.sub("", string)
     # normalise whitespace
     string = string.strip()
-    string = sub(r"\s+", " ", string)
+    string = WHITESPACE_REGEX.sub(" ", string)
     return string
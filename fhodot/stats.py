@@ -2,14 +2,16 @@
 
 
 from datetime import date
-from logging import debug, info
+from logging import info
 
-from sqlalchemy.orm import joinedload
+from geoalchemy2.functions import ST_Intersects
+from sqlalchemy import and_, case, func, literal, not_, select, true, union_all
 
 from fhodot.database import Session
 from fhodot.models import (FHRSAuthority, FHRSAuthorityStatistic,
-                           LocalAuthorityDistrict,
-                           OSMLocalAuthorityDistrictStatistic)
+                           FHRSEstablishment, LocalAuthorityDistrict,
+                           OSMFHRSMapping, OSMLocalAuthorityDistrictStatistic,
+                           OSMObject)
 
 
 FHRS_STATUSES = ["matched_same_postcodes", "matched_different_postcodes",
@@ -18,102 +20,115 @@ OSM_STATUSES = ["matched_same_postcodes", "matched_different_postcodes",
                 "mismatched", "unmatched"]
 
 
-def get_fhrs_stats_for_authority(authority):
-    """Return FHRS establishment statistics for FHRS authority"""
+def get_fhrs_status_query():
+    """Return query of authority code and status for each establishment
 
-    statuses = []
-    for establishment in authority.establishments:
-        status = "unmatched_with_location"
-        if establishment.osm_mappings:
-            if any(not osm_mapping.postcodes_match
-                   for osm_mapping in establishment.osm_mappings):
-                status = "matched_different_postcodes"
-            else:
-                status = "matched_same_postcodes"
-        elif not establishment.location:
-            status = "unmatched_without_location"
-        statuses.append(status)
-
-    stats = []
-    for status in FHRS_STATUSES:
-        stats.append(
-            FHRSAuthorityStatistic(
-                authority_code=authority.code,
-                date=date.today(),
-                statistic=status,
-                value=statuses.count(status)))
-
-    return stats
-
-
-def get_fhrs_stats_by_authority():
-    """Return FHRS statistics by authority for all authorities"""
-
-    query = Session.query(FHRSAuthority.code)
-    authority_codes = [row[0] for row in query]
-
-    authority_stats = []
-    for authority_code in authority_codes:
-        authority = Session.query(FHRSAuthority).\
-            options(joinedload("establishments").joinedload("osm_mappings").
-                    joinedload("osm_object")).\
-            get(authority_code)
-
-        debug(f"Calculating statistics for FHRS authority {authority.name}")
-        authority_stats.extend(get_fhrs_stats_for_authority(authority))
-
-    return authority_stats
-
-
-def get_osm_stats_for_district(district):
-    """Return OSM object statistics for local authority district
-
-    district (LocalAuthorityDistrict)
+    Columns are labelled code and statistic for use with
+    insert_status_counts_in_session.
     """
 
-    statuses = []
-    for osm_object in district.osm_objects:
-        status = "unmatched"
-        if osm_object.fhrs_mappings:
-            if any(not fhrs_mapping.fhrs_establishment
-                   for fhrs_mapping in osm_object.fhrs_mappings):
-                status = "mismatched"
-            elif any(not fhrs_mapping.postcodes_match
-                     for fhrs_mapping in osm_object.fhrs_mappings):
-                status = "matched_different_postcodes"
-            else:
-                status = "matched_same_postcodes"
-        statuses.append(status)
-
-    stats = []
-    for status in OSM_STATUSES:
-        stats.append(
-            OSMLocalAuthorityDistrictStatistic(
-                district_code=district.code,
-                date=date.today(),
-                statistic=status,
-                value=statuses.count(status)))
-
-    return stats
-
-
-def get_osm_stats_by_district():
-    """Return OSM object statistics by district for all districts"""
-
-    query = Session.query(LocalAuthorityDistrict.code)
-    district_codes = [row[0] for row in query]
-
-    district_stats = []
-    for district_code in district_codes:
-        district = Session.query(LocalAuthorityDistrict).\
-            options(joinedload("osm_objects").joinedload("fhrs_mappings").
-                    joinedload("fhrs_establishment")).\
-            get(district_code)
+    # whether any of each matched establishment's OSM objects has a
+    # different postcode (comparisons with a null postcode are null)
+    mappings = Session.query(
+        OSMFHRSMapping.fhrs_id.label("fhrs_id"),
+        func.bool_or(not_(func.coalesce(OSMFHRSMapping.postcodes_match,
+                                        False))).label("any_different")).\
+        join(OSMObject, OSMObject.osm_id_single_space ==
+             OSMFHRSMapping.osm_id_single_space).\
+        join(FHRSEstablishment,
+             FHRSEstablishment.fhrs_id == OSMFHRSMapping.fhrs_id).\
+        group_by(OSMFHRSMapping.fhrs_id).\
+        subquery()
+
+    status = case(
+        [(mappings.c.any_different, "matched_different_postcodes"),
+         (mappings.c.fhrs_id.isnot(None), "matched_same_postcodes"),
+         (FHRSEstablishment.location.is_(None),
+          "unmatched_without_location")],
+        else_="unmatched_with_location")
+
+    return Session.query(FHRSEstablishment.authority_code.label("code"),
+                         status.label("statistic")).\
+        outerjoin(mappings, mappings.c.fhrs_id == FHRSEstablishment.fhrs_id)
+
+
+def get_osm_status_query():
+    """Return query of district code and status for each OSM object
+
+    Columns are labelled code and statistic for use with
+    insert_status_counts_in_session.
+    """
 
-        debug(f"Calculating OSM statistics for district {district.name}")
-        district_stats.extend(get_osm_stats_for_district(district))
+    # whether any of each matched OSM object's FHRS IDs doesn't match an
+    # establishment or matches one with a different postcode
+    mappings = Session.query(
+        OSMFHRSMapping.osm_id_single_space.label("osm_id"),
+        func.bool_or(FHRSEstablishment.fhrs_id.is_(None)).\
+            label("any_mismatched"),
+        func.bool_or(not_(func.coalesce(OSMFHRSMapping.postcodes_match,
+                                        False))).label("any_different")).\
+        join(OSMObject, OSMObject.osm_id_single_space ==
+             OSMFHRSMapping.osm_id_single_space).\
+        outerjoin(FHRSEstablishment,
+                  FHRSEstablishment.fhrs_id == OSMFHRSMapping.fhrs_id).\
+        group_by(OSMFHRSMapping.osm_id_single_space).\
+        subquery()
+
+    status = case(
+        [(mappings.c.any_mismatched, "mismatched"),
+         (mappings.c.any_different, "matched_different_postcodes"),
+         (mappings.c.osm_id.isnot(None), "matched_same_postcodes")],
+        else_="unmatched")
+
+    return Session.query(LocalAuthorityDistrict.code.label("code"),
+                         status.label("statistic")).\
+        join(OSMObject, ST_Intersects(OSMObject.location,
+                                      LocalAuthorityDistrict.boundary)).\
+        outerjoin(mappings,
+                  mappings.c.osm_id == OSMObject.osm_id_single_space)
+
+
+def insert_status_counts_in_session(statistic_code_column, code_column,
+                                    statuses, status_query, stats_date):
+    """Insert counts of each status for each authority/district
+
+    Statuses are counted and inserted by the database using a single
+    INSERT ... SELECT rather than loading each object into Python. This
+    doesn't commit the session.
+
+    statistic_code_column: FHRSAuthorityStatistic.authority_code or
+        OSMLocalAuthorityDistrictStatistic.district_code
+    code_column: FHRSAuthority.code or LocalAuthorityDistrict.code; a
+        statistic is inserted for every code and status, including
+        zero counts
+    statuses (list of strings): statuses to insert
+    status_query: query with code and statistic columns for each object
+    stats_date (date): date of statistics
+    """
 
-    return district_stats
+    status_rows = status_query.subquery()
+    counts = Session.query(status_rows.c.code, status_rows.c.statistic,
+                           func.count().label("value")).\
+        group_by(status_rows.c.code, status_rows.c.statistic).\
+        subquery()
+    statistics = union_all(
+        *[select([literal(status).label("statistic")])
+          for status in statuses]).\
+        alias()
+
+    rows = Session.query(code_column, literal(stats_date),
+                         statistics.c.statistic,
+                         func.coalesce(counts.c.value, 0)).\
+        join(statistics, true()).\
+        outerjoin(counts,
+                  and_(counts.c.code == code_column,
+                       counts.c.statistic == statistics.c.statistic))
+
+    statistic_table = statistic_code_column.class_.__table__
+    Session.execute(
+        statistic_table.insert().from_select(
+            [statistic_code_column.key, "date", "statistic", "value"],
+            rows.statement))
 
 
 def replace_current_stats_in_session():
@@ -122,14 +137,22 @@ def replace_current_stats_in_session():
     This doesn't commit the session.
     """
 
+    # the same date throughout, even if this runs over midnight
+    today = date.today()
+
     info("Calculating statistics for FHRS authorities")
     Session.query(FHRSAuthorityStatistic).\
-        filter(FHRSAuthorityStatistic.date == date.today()).\
+        filter(FHRSAuthorityStatistic.date == today).\
         delete()
-    Session.add_all(get_fhrs_stats_by_authority())
+    insert_status_counts_in_session(
+        FHRSAuthorityStatistic.authority_code, FHRSAuthority.code,
+        FHRS_STATUSES, get_fhrs_status_query(), today)
 
     info("Calculating statistics for OSM objects")
     Session.query(OSMLocalAuthorityDistrictStatistic).\
-        filter(OSMLocalAuthorityDistrictStatistic.date == date.today()).\
+        filter(OSMLocalAuthorityDistrictStatistic.date == today).\
         delete()
-    Session.add_all(get_osm_stats_by_district())
+    insert_status_counts_in_session(
+        OSMLocalAuthorityDistrictStatistic.district_code,
+        LocalAuthorityDistrict.code, OSM_STATUSES, get_osm_status_query(),
+        today)
@@ -8,11 +8,44 @@ ALTER TABLE import.osm ADD CONSTRAINT osm_pkey
     PRIMARY KEY (osm_id_single_space);
 DROP INDEX IF EXISTS import.osm_id_single_space_idx;
 
+-- store OSM type and ID by type (see OSMObject model) rather than
+-- computing them from the single space ID whenever they're selected
+ALTER TABLE import.osm ADD COLUMN osm_id_by_type BIGINT
+    GENERATED ALWAYS AS (
+        CASE
+            WHEN osm_id_single_space <= -100000000000000000
+                THEN -osm_id_single_space - 100000000000000000
+            WHEN osm_id_single_space < 0 THEN -osm_id_single_space
+            ELSE osm_id_single_space
+        END
+    ) STORED;
+ALTER TABLE import.osm ADD COLUMN osm_type VARCHAR(8)
+    GENERATED ALWAYS AS (
+        CASE
+            WHEN osm_id_single_space <= -100000000000000000 THEN 'relation'
+            WHEN osm_id_single_space < 0 THEN 'way'
+            ELSE 'node'
+        END
+    ) STORED;
+-- likewise whether the fhrs:id string is valid, rather than matching
+-- the regex whenever it's selected
+ALTER TABLE import.osm ADD COLUMN fhrs_ids_string_valid BOOLEAN
+    GENERATED ALWAYS AS (
+        fhrs_ids_string = '' OR fhrs_ids_string ~ '^[0-9]+(;[0-9]+)*$'
+    ) STORED;
+
 -- convert geometry column to location (centroid points, type geography)
 ALTER TABLE import.osm ADD COLUMN location GEOGRAPHY;
 UPDATE import.osm SET location = ST_Centroid(geometry)::geography;
 ALTER TABLE import.osm DROP COLUMN geometry;
 
+-- store coordinates (see OSMObject model) rather than calculating them
+-- whenever they're selected
+ALTER TABLE import.osm ADD COLUMN lat DOUBLE PRECISION
+    GENERATED ALWAYS AS (ST_Y(location::geometry)) STORED;
+ALTER TABLE import.osm ADD COLUMN lon DOUBLE PRECISION
+    GENERATED ALWAYS AS (ST_X(location::geometry)) STORED;
+
 -- create index on location column
 DROP INDEX IF EXISTS idx_osm_location;
 CREATE INDEX idx_osm_location ON import.osm USING gist (location);
@@ -22,32 +55,55 @@ DROP TABLE IF EXISTS import.osm_fhrs_mapping;
 CREATE TABLE import.osm_fhrs_mapping (
     osm_id_single_space BIGINT REFERENCES import.osm (osm_id_single_space),
     fhrs_id INT,
+    -- null if there is no establishment with the FHRS ID
+    distance DOUBLE PRECISION,
+    distant BOOLEAN,
     PRIMARY KEY (osm_id_single_space, fhrs_id)
 );
 
+-- distances are calculated from the current FHRS establishments here so
+-- that they're available as soon as the tables are rotated, and are
+-- refreshed by update_fhrs once establishments have been updated. The
+-- threshold matches DISTANT_THRESHOLD_METRES in fhodot/models/mapping.py
 INSERT INTO import.osm_fhrs_mapping
-    -- DISTINCT just in case an OSM object is linked to the same FHRS
-    -- establishment multiple times
-    SELECT DISTINCT
-        osm_id_single_space,
-        unnest(
-            CASE
-                -- check format of fhrs:id string
-                -- allow optional single space after semicolons
-                -- don't allow trailing semicolon
-                WHEN fhrs_ids_string ~ '^([0-9]+(; ?(?!$))?)+$'
-                    THEN string_to_array(fhrs_ids_string, ';')
-                -- if invalid, create empty text array to unnest
-                ELSE '{}'::text[]
-            END
-        )::int AS fhrs_id
-    FROM import.osm;
+    SELECT
+        mapping.osm_id_single_space,
+        mapping.fhrs_id,
+        ST_Distance(osm.location, fhrs.location) AS distance,
+        NOT ST_DWithin(osm.location, fhrs.location, 250, false) AS distant
+    FROM (
+        -- DISTINCT just in case an OSM object is linked to the same FHRS
+        -- establishment multiple times
+        SELECT DISTINCT
+            osm_id_single_space,
+            unnest(
+                CASE
+                    -- check format of fhrs:id string
+                    -- allow optional single space after semicolons
+                    -- don't allow trailing semicolon
+                    WHEN fhrs_ids_string ~ '^([0-9]+(; ?(?!$))?)+$'
+                        THEN string_to_array(fhrs_ids_string, ';')
+                    -- if invalid, create empty text array to unnest
+                    ELSE '{}'::text[]
+                END
+            )::int AS fhrs_id
+        FROM import.osm
+    ) AS mapping
+    JOIN import.osm AS osm
+        ON osm.osm_id_single_space = mapping.osm_id_single_space
+    LEFT JOIN public.fhrs_establishments AS fhrs
+        ON fhrs.fhrs_id = mapping.fhrs_id;
 
 -- create index on fhrs_id (no need to create one on id because it's
 -- the first column of the primary key
 DROP INDEX IF EXISTS import.idx_osm_fhrs_mapping_fhrs_id;
 CREATE INDEX idx_osm_fhrs_mapping_fhrs_id ON import.osm_fhrs_mapping (fhrs_id);
 
+-- partial index used when finding OSM objects with distant matches
+DROP INDEX IF EXISTS import.idx_osm_fhrs_mapping_distant;
+CREATE INDEX idx_osm_fhrs_mapping_distant
+    ON import.osm_fhrs_mapping (osm_id_single_space) WHERE distant;
+
 -- rotate schemas here rather than using imposm deploy option in order
 -- to include the materialized view
 DROP SCHEMA IF EXISTS backup CASCADE;
@@ -14,4 +14,6 @@ find /home/gregrs/public_html/fhodot/* -maxdepth 0 \
 	-not -name '.htaccess' \
 	-delete
 cp fhodot/app/ui/dist/* /home/gregrs/public_html/fhodot/
+echo "Adding any new database tables, columns and indexes"
+venv/bin/python -m scripts.upgrade_database || exit 1
 touch /home/gregrs/public_html/wsgi-bin/fhodot.wsgi
@@ -4,9 +4,9 @@ from logging import info
 from os import listdir
 from os.path import join
 
-from fhodot.database import session_scope, Session
+from fhodot.database import session_scope
 from fhodot.models.os_open_names import OSOpenNamesObject, OSPlace, OSRoad
-from fhodot.os_open_names import import_csv
+from fhodot.os_open_names import import_csv_files
 
 open_names_dir = "import/os_open_names"
 
@@ -16,11 +16,19 @@ with open(join(open_names_dir, "DOC/OS_Open_Names_Header.csv"),
           "r", encoding="utf-8-sig") as headers_file:
     headers = headers_file.readline().strip().split(",")
 
-with session_scope() as session:
-    Session.query(OSPlace).delete() # all places
-    Session.query(OSRoad).delete() # all roads
-    data_dir = join(open_names_dir, "DATA")
-    for filename in listdir(data_dir):
-        info(f"Reading {filename}")
-        import_csv(join(data_dir, filename), headers)
-    info(f"Committing to database")
+# guarded because import_csv_files spawns worker processes, which import
+# the main module
+if __name__ == "__main__":
+    # whole import is one transaction, without autoflush as rows are
+    # loaded with COPY rather than added as pending ORM objects
+    with session_scope() as session, session.no_autoflush:
+        # recreate tables rather than deleting all places and roads, so
+        # that no dead rows are left behind and any changes to the models'
+        # columns are applied
+        for table in (OSPlace.__table__, OSRoad.__table__):
+            table.drop(session.connection(), checkfirst=True)
+            table.create(session.connection())
+        data_dir = join(open_names_dir, "DATA")
+        import_csv_files([join(data_dir, filename)
+                          for filename in listdir(data_dir)], headers)
+        info(f"Committing to database")
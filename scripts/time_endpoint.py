@@ -1,38 +1,63 @@
 """Function for timing an API endpoint"""
 
+from cProfile import Profile
+from pstats import Stats
+from statistics import mean, median, quantiles
 from time import perf_counter
 from werkzeug.test import Client
 from fhodot.app import app
 
 URL = "http://127.0.0.1:5000/api/suggest?l=-0.14619956627642153&b=51.50793696905042&r=-0.11392722740923403&t=51.52129040029465"
-REPEATS = 5
+REPEATS = 50
+# set to True to print the functions taking the longest cumulative time
+PROFILE = False
 
 URL = URL.replace("http://127.0.0.1:5000", "")
 
 client = Client(app)
 
-def fetch_and_calculate_average_time(url, repeats=1):
+
+def get_response_string(url):
+    """Get URL from API and return the response body"""
+    response = client.get(url)
+    # include time taken to generate a streamed response
+    return b"".join(response[0])
+
+
+def fetch_and_calculate_average_time(url, repeats=1, profile=False):
     """Time how long it takes to get URL from API
 
-    If repeats > 1, calculate the average time, excluding the first
-    attempt since this often takes longer than subsequent attempts.
+    URL is fetched once before timing, since the first attempt often
+    takes longer than subsequent attempts. If repeats > 1, calculate the
+    mean, median and 95th percentile times. If profile is True, also
+    print profiling statistics for the timed attempts.
     """
     print(f"Timing {url} {repeats} times")
 
+    string = get_response_string(url) # warm up
+    print(f"JSON string of length {len(string)}")
+
+    profiler = Profile() if profile else None
     timings = []
     for _ in range(0, repeats):
+        if profiler:
+            profiler.enable()
         tic = perf_counter()
-        response = client.get(url)
+        get_response_string(url)
         toc = perf_counter()
+        if profiler:
+            profiler.disable()
 
-        string = list(response[0])[0]
         timings.append(toc - tic)
-        print(f"{toc - tic:0.4f} seconds for JSON string " +
-              f"of length {len(string)}")
+        print(f"{toc - tic:0.4f} seconds")
 
     if repeats > 1:
-        timings = timings[1:] # discard first
-        average = sum(timings) / len(timings)
-        print(f"Average time without first attempt: {average:0.4f}")
+        print(f"Mean: {mean(timings):0.4f}, " +
+              f"median: {median(timings):0.4f}, " +
+              f"95th percentile: {quantiles(timings, n=20)[18]:0.4f}")
+
+    if profiler:
+        Stats(profiler).sort_stats("cumulative").print_stats(20)
+
 
-fetch_and_calculate_average_time(URL, REPEATS)
+fetch_and_calculate_average_time(URL, REPEATS, PROFILE)
@@ -1,7 +1,7 @@
 """Update the FHRS database tables using the FSA's API"""
 
 
-from logging import debug, info
+from logging import debug, error, info
 
 from fhodot import fetch_fhrs
 from fhodot.database import session_scope
@@ -13,10 +13,18 @@ authorities_xml = fetch_fhrs.download_authorities_from_api()
 info("Parsing XML")
 authorities = fetch_fhrs.parse_xml_authorities(authorities_xml)
 
-# database will not be committed until process completes and will be
-# rolled back if any individual step fails
+# authorities are merged in one transaction and then each authority's
+# establishments are replaced in their own transaction, so that the
+# transactions don't grow with the whole import and a failure only
+# rolls back that authority. Each authority's last published date is
+# stored in the same transaction as its establishments, so any that
+# fail are fetched again next time. Autoflush is disabled as the import
+# uses bulk statements rather than pending ORM objects, so there's
+# nothing to flush before each query.
 
-with session_scope() as session:
+failed_names = []
+
+with session_scope() as session, session.no_autoflush:
     info("Comparing authority counts")
     fetch_fhrs.compare_authority_counts(authorities)
 
@@ -27,20 +35,29 @@ with session_scope() as session:
     to_fetch = fetch_fhrs.get_authorities_requiring_fetch(authorities)
 
     info("Merging all authority data into database")
-    fetch_fhrs.merge_authorities_with_session(authorities)
-
-    for authority in to_fetch:
+    fetch_fhrs.merge_authorities_with_session(
+        authorities, {authority.code for authority in to_fetch})
+    session.commit()
+
+    # XML files downloaded and parsed concurrently in threads, while
+    # establishments are written to the database from this thread only
+    for authority, future in \
+            fetch_fhrs.fetch_establishments_for_authorities(to_fetch):
         info(f"Updating authority '{authority.name}'")
 
-        debug("Downloading XML file")
-        est_xml = fetch_fhrs.download_establishments_xml_file(authority)
-
-        debug("Parsing XML file")
-        establishments = fetch_fhrs.parse_xml_establishments(est_xml)
+        try:
+            establishments = future.result()
 
-        debug("Replacing authority's establishments in database")
-        fetch_fhrs.replace_establishments_for_authority_in_session(
-            authority, establishments)
+            debug("Replacing authority's establishments in database")
+            fetch_fhrs.replace_establishments_for_authority_in_session(
+                authority, establishments)
+            fetch_fhrs.set_authority_last_published_in_session(authority)
+            session.commit()
+        except Exception: # pylint: disable=broad-except
+            error(f"Could not update authority '{authority.name}'",
+                  exc_info=True)
+            session.rollback()
+            failed_names.append(authority.name)
 
     if not to_fetch:
         info("All authorities' establishment data is already up to date")
@@ -48,4 +65,11 @@ with session_scope() as session:
     info("Associating authorities with local authority districts")
     fetch_fhrs.add_authority_districts_in_session()
 
+    info("Updating distances between mapped OSM objects and establishments")
+    fetch_fhrs.update_mapping_distances_in_session()
+
+if failed_names:
+    raise RuntimeError("Could not update authorities: " +
+                       ", ".join(failed_names))
+
 info("FHRS data updated successfully")
@@ -0,0 +1,16 @@
+"""Add tables, columns and indexes missing from an existing database
+
+Run after deploying changes to the models, before the app or the other
+scripts use the new columns.
+"""
+
+# importing fhodot.models registers every model with DeclarativeBase
+import fhodot.models # pylint: disable=unused-import
+from fhodot.database import engine
+from fhodot.models.base import (add_missing_columns, add_missing_indexes,
+                                DeclarativeBase)
+
+
+DeclarativeBase.metadata.create_all(bind=engine)
+add_missing_columns(engine)
+add_missing_indexes(engine)
@@ -4,8 +4,10 @@ Tests are contained in the individual modules and should inherit the
 TestCaseWithReconfiguredSession class.
 """
 
+from contextlib import contextmanager
 from unittest import TestCase
 
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
 
 from fhodot.database import engine, Session
@@ -34,3 +36,24 @@ class TestCaseWithReconfiguredSession(TestCase):
         self.transaction.rollback() # including commits
         self.connection.close()
         # N.B. doesn't reconfigure Session to bind to engine
+
+    @contextmanager
+    def record_statements(self):
+        """Record SQL statements executed on the test connection
+
+        Yields a list to which each statement executed within the with
+        block is appended, e.g. to check that queries aren't issued per
+        object.
+        """
+        statements = []
+
+        def record_statement(*args):
+            statements.append(args[2])
+
+        event.listen(self.connection, "before_cursor_execute",
+                     record_statement)
+        try:
+            yield statements
+        finally:
+            event.remove(self.connection, "before_cursor_execute",
+                         record_statement)
@@ -0,0 +1,93 @@
+"""Tests for fhodot.app.cache
+
+N.B. These tests depend upon the Redis server.
+"""
+
+from unittest import TestCase
+
+from fhodot.app import app
+from fhodot.app.cache import (cache_control, cached_response, get_cache_key,
+                              redis_client)
+from fhodot.app.utils import get_json_response, get_json_stream_response
+
+
+class TestCachedResponse(TestCase):
+    """Test cached_response decorator"""
+
+    def setUp(self):
+        self.calls = 0
+
+        @cached_response(ttl=60)
+        def view():
+            self.calls += 1
+            return get_json_response({"calls": self.calls})
+
+        self.view = view
+        self.path = "/test_cache?zoom=10"
+        with app.test_request_context(self.path):
+            self.key = get_cache_key()
+        redis_client.delete(self.key)
+
+
+    def tearDown(self):
+        redis_client.delete(self.key)
+
+
+    def test_second_request_cached(self):
+        """Second request should return cached body without calling view"""
+        for _ in range(2):
+            with app.test_request_context(self.path):
+                response = self.view()
+            self.assertEqual(response.get_data(), b'{"calls":1}')
+            self.assertEqual(response.content_type, "application/json")
+        self.assertEqual(self.calls, 1)
+
+
+    def test_different_query_not_cached(self):
+        """Request with different query string should call view"""
+        with app.test_request_context(self.path):
+            self.view()
+        with app.test_request_context("/test_cache?zoom=11"):
+            redis_client.delete(get_cache_key())
+            response = self.view()
+            redis_client.delete(get_cache_key())
+        self.assertEqual(response.get_data(), b'{"calls":2}')
+
+
+    def test_cache_control(self):
+        """Cached and uncached responses should allow public caching"""
+        for _ in range(2):
+            with app.test_request_context(self.path):
+                response = self.view()
+            self.assertTrue(response.cache_control.public)
+            self.assertEqual(response.cache_control.max_age, 60)
+
+
+class TestCacheControl(TestCase):
+    """Test cache_control decorator"""
+
+    def test_streamed_response(self):
+        """Streamed response should allow public caching"""
+
+        @cache_control(max_age=300)
+        def view():
+            return get_json_stream_response(iter([b"{}"]))
+
+        with app.test_request_context("/test_cache"):
+            response = view()
+        self.assertTrue(response.is_streamed)
+        self.assertTrue(response.cache_control.public)
+        self.assertEqual(response.cache_control.max_age, 300)
+
+
+    def test_error_response(self):
+        """Unsuccessful response should not allow caching"""
+
+        @cache_control(max_age=300)
+        def view():
+            return get_json_response({}), 400
+
+        with app.test_request_context("/test_cache"):
+            response = view()
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(response.cache_control.max_age)
@@ -5,7 +5,7 @@ from unittest import TestCase
 from fhodot.app import parse_addresses
 from fhodot.database import Session
 from fhodot.models.fhrs import FHRSEstablishment
-from fhodot.models.os_open_names import OSPlace
+from fhodot.models.os_open_names import OSPlace, OSRoad
 
 
 # Some of these tests rely on external data. Plain assert statements
@@ -47,6 +47,8 @@ class TestPrepareTokens(TestCase):
 
         tokens = parse_addresses.prepare_tokens(self.est)
         self.assertEqual(len(tokens), 1)
+        # establishment itself unchanged
+        self.assertEqual(self.est.address_1, "Establishment name")
 
 
     def test_empty_lines(self):
@@ -71,6 +73,15 @@ class TestPrepareTokens(TestCase):
         self.assertEqual(tokens[1], helper_create_dict("Second token"))
 
 
+    def test_split_comma_empty(self):
+        """Empty tokens between commas removed"""
+
+        self.est.address_1 = "First token,, Second token,"
+
+        tokens = parse_addresses.prepare_tokens(self.est)
+        self.assertEqual(len(tokens), 2)
+
+
     def test_strip_whitespace(self):
         """Spaces stripped from tokens"""
 
@@ -359,6 +370,17 @@ class TestIsRoad(TestCase):
         self.assertFalse(parse_addresses.is_road("Not a road", "B"))
 
 
+    def test_gb_roads_by_name(self):
+        """In GB, looks up road in supplied dict if present"""
+        roads_by_name = parse_addresses.get_os_objects_by_name(
+            ["Oxford Street", "Not a road", "123"], OSRoad, "W")
+        self.assertEqual(list(roads_by_name.keys()), ["oxford street"])
+        self.assertTrue(
+            parse_addresses.is_road("Oxford Street", "W", roads_by_name))
+        self.assertFalse(
+            parse_addresses.is_road("Not a road", "W", roads_by_name))
+
+
 class TestGetFloor(TestCase):
     """Test get_floor"""
 
@@ -0,0 +1,137 @@
+"""Tests for fhodot.app.routes"""
+
+from fhodot import fetch_fhrs
+from fhodot.app import app, limiter
+from fhodot.database import Session
+from fhodot.models.fhrs import FHRSAuthority, FHRSEstablishment
+from fhodot.models.mapping import OSMFHRSMapping
+from fhodot.models.osm import OSMObject
+from tests import TestCaseWithReconfiguredSession
+
+
+BBOX_PARAMS = "l=-1&b=-1&r=1&t=1"
+
+
+class TestBboxEndpointsQueryCount(TestCaseWithReconfiguredSession):
+    """Test that bbox endpoints don't issue queries per object"""
+
+    def setUp(self):
+        super().setUp()
+        limiter.enabled = False
+        self.client = app.test_client()
+
+        # test authority with not null columns set
+        auth = FHRSAuthority(
+            code=321,
+            name="Authority Name",
+            region_name="Authority Region",
+            xml_url="http://ratings.food.gov.uk/OpenDataFiles/FHRS760en-GB.xml")
+        Session.add(auth)
+
+        # several matched pairs so that any per-object queries add up
+        for i in range(1, 6):
+            est = FHRSEstablishment(fhrs_id=i, name="Establishment Name",
+                                    postcode="AB12 3XY", authority=auth)
+            est.set_location(lat=f"0.{i}", lon=f"0.{i}")
+            osm = OSMObject(osm_id_single_space=i, name="OSM Name",
+                            addr_postcode="AB12 3XY",
+                            location=f"POINT(0.{i} 0.{i})")
+            Session.add_all([est, osm, OSMFHRSMapping(osm_object=osm,
+                                                      fhrs_id=i)])
+
+        # one matched pair about 11km apart, with different names so
+        # that it isn't involved in suggested matches
+        est = FHRSEstablishment(fhrs_id=99, name="Distant Establishment",
+                                postcode="AB12 3XY", authority=auth)
+        est.set_location(lat="0.8", lon="0.9")
+        osm = OSMObject(osm_id_single_space=99, name="Distant Object",
+                        addr_postcode="AB12 3XY", location="POINT(0.9 0.9)")
+        Session.add_all([est, osm, OSMFHRSMapping(osm_object=osm,
+                                                  fhrs_id=99)])
+        Session.flush()
+        fetch_fhrs.update_mapping_distances_in_session()
+        Session.commit()
+        Session.remove()
+
+
+    def tearDown(self):
+        limiter.enabled = True
+        super().tearDown()
+
+
+    def test_fhrs(self):
+        """Count, establishments, mappings and without-location queries"""
+        # responses are streamed, so read them while recording
+        with self.record_statements() as statements:
+            response = self.client.get(f"/api/fhrs?{BBOX_PARAMS}")
+            features = response.get_json()["features"]
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(features), 6)
+        self.assertLessEqual(len(statements), 5)
+
+
+    def test_osm(self):
+        """Count, OSM objects and mappings queries"""
+        # responses are streamed, so read them while recording
+        with self.record_statements() as statements:
+            response = self.client.get(f"/api/osm?{BBOX_PARAMS}")
+            features = response.get_json()["features"]
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(features), 6)
+        self.assertLessEqual(len(statements), 3)
+
+
+    def test_distant(self):
+        """Only distant pair returned, using OSM objects and mappings
+        queries
+        """
+        with self.record_statements() as statements:
+            response = self.client.get(f"/api/distant?{BBOX_PARAMS}")
+            data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(statements), 3)
+
+        points = data["points"]["features"]
+        self.assertEqual(len(points), 1)
+        mappings = points[0]["properties"]["fhrsMappings"]
+        self.assertEqual(len(mappings), 1)
+        self.assertEqual(mappings[0]["fhrsID"], 99)
+        self.assertAlmostEqual(mappings[0]["distance"], 11057, delta=100)
+
+        lines = data["lines"]["features"]
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]["geometry"]["coordinates"],
+                         [[0.9, 0.9], [0.9, 0.8]])
+
+
+    def test_postcode(self):
+        """Count, OSM objects/establishments and both mappings queries"""
+        with self.record_statements() as statements:
+            response = self.client.get(f"/api/postcode?{BBOX_PARAMS}")
+            features = response.get_json()["features"]
+        self.assertEqual(response.status_code, 200)
+        # all objects with matching postcodes are already matched
+        self.assertEqual(len(features), 0)
+        self.assertLessEqual(len(statements), 4)
+
+
+    def test_suggest(self):
+        """Count, nearby, full objects and their mappings queries"""
+        # unmatched establishments with names matching the OSM objects
+        for i in range(6, 11):
+            est = FHRSEstablishment(fhrs_id=i, name="OSM Name",
+                                    postcode="AB12 3XY", authority_code=321)
+            est.set_location(lat=f"0.{i-5}", lon=f"0.{i-5}")
+            Session.add(est)
+        Session.commit()
+        Session.remove()
+
+        with self.record_statements() as statements:
+            response = self.client.get(f"/api/suggest?{BBOX_PARAMS}")
+            features = response.get_json()["features"]
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(features), 5)
+        for feature in features:
+            self.assertEqual(
+                len(feature["properties"]["suggestedMatches"]), 1)
+        self.assertLessEqual(len(statements), 6)
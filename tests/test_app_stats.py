@@ -0,0 +1,104 @@
+"""Tests for fhodot.app.stats
+
+N.B. These tests depend upon the Redis server.
+"""
+
+from datetime import date, timedelta
+
+from fhodot.app.cache import redis_client
+from fhodot.app.stats import (get_boundary_cache_key, get_fhrs_stats_features,
+                              get_osm_stats_features)
+from fhodot.database import Session
+from fhodot.models import (FHRSAuthority, FHRSAuthorityStatistic,
+                           LocalAuthorityDistrict,
+                           OSMLocalAuthorityDistrictStatistic)
+from tests import TestCaseWithReconfiguredSession
+
+
+BBOX = {"l": -1, "b": -1, "r": 3, "t": 1}
+ZOOM = 8
+# codes not used by real districts so cached boundaries can't clash
+DISTRICT_CODES = [f"T0000000{i}" for i in range(1, 4)]
+
+
+class TestStatsFeatures(TestCaseWithReconfiguredSession):
+    """Test GeoJSON features for FHRS and OSM stats"""
+
+    def setUp(self):
+        super().setUp()
+        self.delete_cached_boundaries()
+
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        # several districts so that any per-district queries add up
+        for i, code in enumerate(DISTRICT_CODES, 1):
+            Session.add(LocalAuthorityDistrict(
+                code=code, name=f"District {i}",
+                boundary=(f"MULTIPOLYGON((({i-1} 0,{i} 0,{i} 0.5," +
+                          f"{i-1} 0.5,{i-1} 0)))")))
+            Session.add(FHRSAuthority(
+                code=i, name=f"Authority {i}", region_name="Region",
+                xml_url="http://ratings.food.gov.uk/OpenDataFiles/" +
+                        f"FHRS76{i}en-GB.xml",
+                district_code=code))
+            # older stats should be ignored
+            for stats_date, statistic, value in (
+                    (yesterday, "matched", 100), (yesterday, "unmatched", 100),
+                    (today, "matched", 3), (today, "unmatched", 4)):
+                Session.add(FHRSAuthorityStatistic(
+                    authority_code=i, date=stats_date, statistic=statistic,
+                    value=value))
+                Session.add(OSMLocalAuthorityDistrictStatistic(
+                    district_code=code, date=stats_date, statistic=statistic,
+                    value=value))
+        Session.commit()
+        Session.remove()
+
+
+    def tearDown(self):
+        self.delete_cached_boundaries()
+        super().tearDown()
+
+
+    def delete_cached_boundaries(self):
+        """Delete test districts' boundaries from the Redis cache"""
+        redis_client.delete(*[get_boundary_cache_key(code, ZOOM)
+                              for code in DISTRICT_CODES])
+
+
+    def check_features(self, features):
+        """Check features have a geometry and combined stats"""
+        self.assertEqual(len(features), 3)
+        for feature in features:
+            self.assertIsNotNone(feature["geometry"])
+            self.assertEqual(feature["properties"]["stats"],
+                             {"matched": 3, "unmatched": 4, "total": 7})
+
+
+    def test_fhrs(self):
+        """Stats and boundaries queries only"""
+        with self.record_statements() as statements:
+            features = get_fhrs_stats_features(BBOX, ZOOM)
+        self.check_features(features)
+        self.assertEqual(features[0]["properties"]["name"], "Authority 1")
+        self.assertEqual(features[0]["properties"]["districtCode"],
+                         "T00000001")
+        self.assertLessEqual(len(statements), 2)
+
+
+    def test_osm(self):
+        """Stats and boundaries queries only"""
+        with self.record_statements() as statements:
+            features = get_osm_stats_features(BBOX, ZOOM)
+        self.check_features(features)
+        self.assertEqual(features[0]["properties"]["name"], "District 1")
+        self.assertLessEqual(len(statements), 2)
+
+
+    def test_boundaries_cached(self):
+        """Stats query only once boundaries cached"""
+        get_fhrs_stats_features(BBOX, ZOOM)
+        with self.record_statements() as statements:
+            features = get_osm_stats_features(BBOX, ZOOM)
+        self.check_features(features)
+        self.assertEqual(len(statements), 1)
@@ -0,0 +1,63 @@
+"""Tests for fhodot.app.suggest"""
+
+from fhodot.app.suggest import get_suggested_matches_by_osm_id
+from fhodot.database import Session
+from fhodot.models.fhrs import FHRSAuthority, FHRSEstablishment
+from fhodot.models.osm import OSMObject
+from tests import TestCaseWithReconfiguredSession
+
+
+BBOX = {"l": -1, "b": -1, "r": 1, "t": 1}
+
+# (OSM name, FHRS name, whether they should be suggested as a match)
+NAME_PAIRS = [
+    # one name a subset of the other, in both directions
+    ("Red Lion", "The Red Lion Public House", True),
+    ("The Red Lion Public House", "Red Lion", True),
+    # symbols and the words they represent
+    ("Fish & Chips", "Fish and Chips", True),
+    ("Bar + Grill", "Bar and Grill", True),
+    # punctuation differences
+    ("St. John's Cafe", "St Johns Cafe", True),
+    ("Whip-Ma-Whop Cafe", "Whip Ma Whop Cafe", True),
+    # dissimilar names
+    ("Pizza Palace", "Golden Dragon", False),
+]
+
+
+class TestGetSuggestedMatches(TestCaseWithReconfiguredSession):
+    """Test suggesting nearby establishments with similar names"""
+
+    def setUp(self):
+        super().setUp()
+        # test authority with not null columns set
+        auth = FHRSAuthority(
+            code=321,
+            name="Authority Name",
+            region_name="Authority Region",
+            xml_url="http://ratings.food.gov.uk/OpenDataFiles/FHRS760en-GB.xml")
+        Session.add(auth)
+
+        # each pair at the same location, ~1km from the next pair
+        for i, (osm_name, fhrs_name, _) in enumerate(NAME_PAIRS, 1):
+            est = FHRSEstablishment(fhrs_id=i, name=fhrs_name,
+                                    authority=auth)
+            est.set_location(lat="0", lon=f"0.0{i}")
+            Session.add_all([est, OSMObject(osm_id_single_space=i,
+                                            name=osm_name,
+                                            location=f"POINT(0.0{i} 0)")])
+        Session.commit()
+
+
+    # inherits tearDown
+
+
+    def test_name_variations(self):
+        """Names differing in subsets, symbols and punctuation match"""
+
+        matches_by_osm_id = get_suggested_matches_by_osm_id(BBOX)
+        for i, (osm_name, fhrs_name, expected) in enumerate(NAME_PAIRS, 1):
+            with self.subTest(osm_name=osm_name, fhrs_name=fhrs_name):
+                fhrs_ids = [fhrs_est.fhrs_id
+                            for fhrs_est in matches_by_osm_id.get(i, [])]
+                self.assertEqual(fhrs_ids, [i] if expected else [])
@@ -1,13 +1,19 @@
 """Tests for fhodot.app.utils"""
 
+from gzip import decompress
 from unittest import TestCase
 
 from flask import request
+from orjson import loads
 from sqlalchemy.orm.query import Query
 from werkzeug.exceptions import BadRequest
 
 from fhodot.app import app
-from fhodot.app.utils import get_bbox, query_within_bbox
+from fhodot.app.utils import (get_bbox, get_features_stream_response,
+                              get_geojson_feature,
+                              get_geojson_feature_collection,
+                              get_geojson_line, get_geojson_point,
+                              get_json_response, query_within_bbox)
 from fhodot.database import Session
 from fhodot.models.fhrs import FHRSAuthority, FHRSEstablishment
 from fhodot.models.osm import OSMObject
@@ -59,6 +65,101 @@ class TestGetBbox(TestCase):
                     get_bbox(request.args)
 
 
+class TestGeoJSON(TestCase):
+    """Test GeoJSON helper functions"""
+
+    def test_point(self):
+        """Should return a Point feature with lon/lat coordinates"""
+        self.assertEqual(
+            get_geojson_point(lat=1.5, lon=-0.5, properties={"a": 1}),
+            {"type": "Feature",
+             "geometry": {"type": "Point", "coordinates": [-0.5, 1.5]},
+             "properties": {"a": 1}})
+
+
+    def test_point_rounded(self):
+        """Should round coordinates to 6 decimal places"""
+        point = get_geojson_point(lat=51.123456789, lon=-0.123456789,
+                                  properties={})
+        self.assertEqual(point["geometry"]["coordinates"],
+                         [-0.123457, 51.123457])
+
+
+    def test_line(self):
+        """Should return a LineString feature with empty properties"""
+        points = [{"lat": 1, "lon": 2}, {"lat": 3, "lon": 4}]
+        self.assertEqual(
+            get_geojson_line(points),
+            {"type": "Feature",
+             "geometry": {"type": "LineString",
+                          "coordinates": [[2, 1], [4, 3]]},
+             "properties": {}})
+
+
+    def test_feature_without_geometry(self):
+        """Should return a feature with null geometry"""
+        self.assertEqual(
+            get_geojson_feature(properties={"a": 1}),
+            {"type": "Feature", "geometry": None, "properties": {"a": 1}})
+
+
+    def test_feature_collection(self):
+        """Should return a plain dict FeatureCollection"""
+        features = [get_geojson_feature()]
+        feature_collection = get_geojson_feature_collection(features)
+        self.assertIs(type(feature_collection), dict)
+        self.assertEqual(feature_collection,
+                         {"type": "FeatureCollection", "features": features})
+
+
+    def test_json_response(self):
+        """Should return a JSON response serialised by orjson"""
+        with app.test_request_context("/test"):
+            response = get_json_response({"a": [1, 2]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, "application/json")
+        self.assertEqual(response.get_data(), b'{"a":[1,2]}')
+
+
+class TestGetFeaturesStreamResponse(TestCase):
+    """Test get_features_stream_response"""
+
+    def setUp(self):
+        self.features = [get_geojson_feature(properties={"a": 1}),
+                         get_geojson_feature(properties={"a": 2})]
+
+
+    def test_feature_collection(self):
+        """Should stream a GeoJSON FeatureCollection by default"""
+        with app.test_request_context("/test"):
+            response = get_features_stream_response(iter(self.features))
+            self.assertEqual(response.content_type, "application/json")
+            self.assertEqual(response.get_json()["features"], self.features)
+
+
+    def test_ndjson(self):
+        """Should stream one feature per line if format is ndjson"""
+        with app.test_request_context("/test?format=ndjson"):
+            response = get_features_stream_response(iter(self.features))
+            self.assertEqual(response.content_type, "application/x-ndjson")
+            lines = response.get_data().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(
+            lines[0],
+            b'{"type":"Feature","geometry":null,"properties":{"a":1}}')
+
+
+    def test_gzip(self):
+        """Should gzip the stream if the client accepts gzip"""
+        with app.test_request_context(
+                "/test", headers={"Accept-Encoding": "gzip, deflate"}):
+            response = get_features_stream_response(iter(self.features))
+            self.assertEqual(response.headers["Content-Encoding"], "gzip")
+            self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+            data = loads(decompress(response.get_data()))
+        self.assertEqual(data["features"], self.features)
+
+
 def helper_create_est(fhrs_id, lat, lon, auth):
     """Helper function to create FHRS establishment for testing"""
     est = FHRSEstablishment(
@@ -3,10 +3,10 @@
 from contextlib import redirect_stderr
 from copy import deepcopy
 from datetime import datetime, timedelta
-from io import StringIO
+from io import BytesIO, StringIO
 from os.path import abspath, dirname, join
-from xml.etree.ElementTree import ParseError
 
+from lxml.etree import XMLSyntaxError
 from requests import RequestException
 from sqlalchemy.exc import IntegrityError
 
@@ -14,6 +14,9 @@ from fhodot import fetch_fhrs
 from fhodot.database import Session, session_scope
 from fhodot.models.fhrs import DeclarativeBase, FHRSAuthority, \
     FHRSEstablishment
+from fhodot.models.district import LocalAuthorityDistrict
+from fhodot.models.mapping import OSMFHRSMapping
+from fhodot.models.osm import OSMObject
 from tests import TestCaseWithReconfiguredSession
 
 
@@ -56,6 +59,14 @@ class TestParseXMLAuthorities(TestCaseWithReconfiguredSession):
         self.assertTrue(isinstance(authorities[0], FHRSAuthority))
 
 
+    def test_parse_xml_authorities_file_like(self):
+        """Parsing XML from a file-like object e.g. an open file"""
+
+        authorities = fetch_fhrs.parse_xml_authorities(
+            BytesIO(AUTHORITIES_VALID_XML.encode("utf-8")))
+        self.assertEqual(len(authorities), 3)
+
+
     def test_parse_xml_authorities_null_code(self):
         """Missing authority code should raise a TypeError"""
 
@@ -75,7 +86,7 @@ class TestParseXMLAuthorities(TestCaseWithReconfiguredSession):
     def test_parse_xml_authorities_bad_xml(self):
         """XML parsing error should log and re-raise exception"""
 
-        with self.assertRaises(ParseError):
+        with self.assertRaises(XMLSyntaxError):
             with self.assertLogs(level="CRITICAL"):
                 fetch_fhrs.parse_xml_authorities("some invalid xml")
 
@@ -133,6 +144,25 @@ class TestCompareAuthorityCounts(TestCaseWithReconfiguredSession):
             fetch_fhrs.compare_authority_counts(authorities)
 
 
+class TestMergeAuthoritiesWithSession(TestCaseWithReconfiguredSession):
+    """Test merging authorities with the session"""
+
+    def test_merge_authorities_duplicate_codes(self):
+        """Last of any authorities with the same code is merged"""
+
+        authorities = fetch_fhrs.parse_xml_authorities(AUTHORITIES_VALID_XML)
+        duplicate = deepcopy(authorities[0])
+        duplicate.name = "Duplicate Authority Name"
+        with self.assertLogs(level="WARNING"):
+            with session_scope():
+                fetch_fhrs.merge_authorities_with_session(
+                    authorities + [duplicate])
+        self.assertEqual(Session.query(FHRSAuthority).count(), 3)
+        self.assertEqual(
+            Session.query(FHRSAuthority).get(duplicate.code).name,
+            "Duplicate Authority Name")
+
+
 class TestGetAuthoritiesRequiringFetch(TestCaseWithReconfiguredSession):
     """Test calculating which FHRS authorities require fetching"""
 
@@ -199,6 +229,16 @@ class TestGetAuthoritiesRequiringFetch(TestCaseWithReconfiguredSession):
         self.assertEqual(result, [self.auth])
 
 
+    def test_get_authorities_requiring_fetch_no_date_xml_multiple(self):
+        """All XML authorities with no last_published should be updated"""
+
+        second_auth = deepcopy(self.auth)
+        second_auth.code = 456
+        result = fetch_fhrs.get_authorities_requiring_fetch(
+            [self.auth, second_auth])
+        self.assertEqual(result, [self.auth, second_auth])
+
+
     def test_get_authorities_requiring_fetch_no_date_database(self):
         """A database authority with no last_published should be updated"""
 
@@ -213,6 +253,35 @@ class TestGetAuthoritiesRequiringFetch(TestCaseWithReconfiguredSession):
         self.assertEqual(result, [self.auth])
 
 
+    def test_get_authorities_requiring_fetch_pending(self):
+        """A merged authority pending establishments should be updated
+        until its last published date is set
+        """
+
+        past = datetime.now() - timedelta(days=1)
+        self.helper_add_authority(past)
+        Session.close()
+
+        self.auth.last_published = datetime.now()
+        with self.assertLogs(level="DEBUG"):
+            with session_scope():
+                fetch_fhrs.merge_authorities_with_session(
+                    [deepcopy(self.auth)], {self.auth.code})
+        self.assertEqual(
+            Session.query(FHRSAuthority).get(123).last_published, past)
+        self.assertEqual(
+            fetch_fhrs.get_authorities_requiring_fetch([self.auth]),
+            [self.auth])
+        Session.close()
+
+        with self.assertLogs(level="DEBUG"):
+            with session_scope():
+                fetch_fhrs.set_authority_last_published_in_session(
+                    self.auth)
+        self.assertEqual(
+            fetch_fhrs.get_authorities_requiring_fetch([self.auth]), [])
+
+
     def test_get_authorities_requiring_fetch_not_in_db(self):
         """An XML authority not in the database should be updated"""
 
@@ -237,11 +306,14 @@ class TestDeleteObsoleteAuthorities(TestCaseWithReconfiguredSession):
             fhrs_id=123, name="Test establishment"))
         self.auth_copy = deepcopy(authorities) # prevent detached instance
 
-        # put into database
+        # put into database (merging doesn't include establishments)
         with self.assertLogs(level="DEBUG"):
             with session_scope():
                 with self.assertLogs(level="DEBUG"):
                     fetch_fhrs.merge_authorities_with_session(authorities)
+                Session.add(FHRSEstablishment(
+                    fhrs_id=123, name="Test establishment",
+                    authority_code=authorities[0].code))
         self.assertEqual(Session.query(FHRSAuthority).count(), 3)
         self.assertEqual(Session.query(FHRSEstablishment).count(), 1)
         Session.close()
@@ -441,7 +513,7 @@ class TestParseXMLEstablishments(TestCaseWithReconfiguredSession):
     def test_parse_xml_establishments_bad_xml(self):
         """XML parsing error should log and re-raise exception"""
 
-        with self.assertRaises(ParseError):
+        with self.assertRaises(XMLSyntaxError):
             with self.assertLogs(level="CRITICAL"):
                 fetch_fhrs.parse_xml_establishments("some invalid xml")
 
@@ -655,3 +727,143 @@ class TestEstablishmentReadWrite(TestCaseWithReconfiguredSession):
         # check that exactly one is present
         self.assertEqual(Session.query(FHRSEstablishment).count(), 1)
         Session.close()
+
+
+class TestAddAuthorityDistricts(TestCaseWithReconfiguredSession):
+    """Test associating authorities with local authority districts"""
+
+    def setUp(self):
+        super().setUp()
+        # three adjacent districts
+        for i in range(1, 4):
+            Session.add(LocalAuthorityDistrict(
+                code=f"T0000000{i}", name=f"District {i}",
+                boundary=(f"MULTIPOLYGON((({i-1} 0,{i} 0,{i} 1," +
+                          f"{i-1} 1,{i-1} 0)))")))
+        for code in range(1, 4):
+            Session.add(FHRSAuthority(
+                code=code,
+                name=f"Authority {code}",
+                region_name="Authority Region",
+                xml_url="http://ratings.food.gov.uk/OpenDataFiles/" +
+                        f"FHRS76{code}en-GB.xml"))
+        Session.flush()
+        self.fhrs_id = 0
+
+
+    # inherits tearDown
+
+
+    def add_establishments(self, authority_code, lon, number,
+                           postcode_original=None):
+        """Add a number of establishments at a longitude"""
+        for _ in range(number):
+            self.fhrs_id += 1
+            est = FHRSEstablishment(fhrs_id=self.fhrs_id,
+                                    name="Establishment Name",
+                                    postcode_original=postcode_original,
+                                    authority_code=authority_code)
+            if lon is not None:
+                est.set_location(lat="0.5", lon=lon)
+            Session.add(est)
+
+
+    def get_district_codes(self):
+        """Return dict of authority codes and their district codes"""
+        return dict(Session.query(FHRSAuthority.code,
+                                  FHRSAuthority.district_code))
+
+
+    def test_add_authority_districts(self):
+        """Authorities associated with district containing over 90% of
+        their located establishments, excluding PRIVATE postcodes, and
+        each district associated with the largest authority only
+        """
+
+        # 10 of 11 in district 1, and PRIVATE postcodes and those without
+        # a location not counted
+        self.add_establishments(1, "0.5", 10)
+        self.add_establishments(1, "1.5", 1)
+        self.add_establishments(1, "1.5", 2, postcode_original="PRIVATE")
+        self.add_establishments(1, None, 5)
+        # all in district 1, which is already associated with authority 1
+        self.add_establishments(2, "0.5", 5)
+        # split equally between districts 2 and 3
+        self.add_establishments(3, "1.5", 3)
+        self.add_establishments(3, "2.5", 3)
+        # previous association should be cleared
+        Session.query(FHRSAuthority).get(3).district_code = "T00000003"
+        Session.flush()
+
+        with self.assertLogs(level="ERROR") as logs:
+            fetch_fhrs.add_authority_districts_in_session()
+        self.assertEqual(self.get_district_codes(),
+                         {1: "T00000001", 2: None, 3: None})
+        self.assertTrue(any("already associated" in message
+                            for message in logs.output))
+
+
+    def test_add_authority_districts_threshold(self):
+        """Authority not associated if 90% or fewer in top district"""
+
+        self.add_establishments(1, "0.5", 9)
+        self.add_establishments(1, "1.5", 1)
+        Session.flush()
+
+        with self.assertLogs(level="ERROR"):
+            fetch_fhrs.add_authority_districts_in_session()
+        self.assertIsNone(self.get_district_codes()[1])
+
+
+class TestUpdateMappingDistances(TestCaseWithReconfiguredSession):
+    """Test storing distances between mapped objects"""
+
+    def setUp(self):
+        super().setUp()
+        # test authority with not null columns set
+        auth = FHRSAuthority(
+            code=760,
+            name="Authority Name",
+            region_name="Authority Region",
+            xml_url="http://ratings.food.gov.uk/OpenDataFiles/FHRS760en-GB.xml")
+        est = FHRSEstablishment(fhrs_id=123, name="Establishment Name",
+                                authority=auth)
+        est.set_location(lat="52", lon="-1")
+        Session.add_all([auth, est])
+        # OSM objects about 11m and 1.1km away, and one mapped to an FHRS
+        # ID that doesn't exist, all with stale distances
+        for osm_id, lat, fhrs_id in ((1, "52.0001", 123), (2, "52.01", 123),
+                                     (3, "52", 456)):
+            osm = OSMObject(osm_id_single_space=osm_id,
+                            location=f"POINT(-1 {lat})")
+            Session.add_all([osm, OSMFHRSMapping(osm_object=osm,
+                                                 fhrs_id=fhrs_id, distance=0,
+                                                 distant=False)])
+        Session.commit()
+
+
+    # inherits tearDown
+
+
+    def test_update_mapping_distances(self):
+        """Distances and distant flags stored, null if no establishment"""
+
+        fetch_fhrs.update_mapping_distances_in_session()
+        mappings = Session.query(OSMFHRSMapping.osm_id_single_space,
+                                 OSMFHRSMapping.distance,
+                                 OSMFHRSMapping.distant).\
+            order_by(OSMFHRSMapping.osm_id_single_space).\
+            all()
+        self.assertAlmostEqual(mappings[0].distance, 11, delta=1)
+        self.assertFalse(mappings[0].distant)
+        self.assertAlmostEqual(mappings[1].distance, 1112, delta=5)
+        self.assertTrue(mappings[1].distant)
+        self.assertIsNone(mappings[2].distance)
+        self.assertIsNone(mappings[2].distant)
+
+
+    def test_single_update(self):
+        """Mappings are updated in a single statement"""
+        with self.record_statements() as statements:
+            fetch_fhrs.update_mapping_distances_in_session()
+        self.assertEqual(len(statements), 1)
@@ -0,0 +1,56 @@
+"""Tests for fhodot.models.base"""
+
+from sqlalchemy import inspect, text
+
+from fhodot.database import Session
+from fhodot.models.base import add_missing_columns, add_missing_indexes
+from fhodot.models.osm import OSMObject
+from tests import TestCaseWithReconfiguredSession
+
+
+class TestAddMissingColumns(TestCaseWithReconfiguredSession):
+    """Test add_missing_columns"""
+
+    def setUp(self):
+        super().setUp()
+        Session.add(OSMObject(osm_id_single_space=123,
+                              location="SRID=4326;POINT(-1.5 52.5)"))
+        Session.commit()
+
+
+    # inherits tearDown
+
+
+    def test_missing_generated_column_added_and_calculated(self):
+        """Missing generated column is added and set for existing rows"""
+        self.connection.execute(text("ALTER TABLE osm DROP COLUMN lat"))
+        add_missing_columns(self.connection)
+        column_names = [column["name"] for column
+                        in inspect(self.connection).get_columns("osm")]
+        self.assertIn("lat", column_names)
+        lat = self.connection.execute(
+            text("SELECT lat FROM osm WHERE osm_id_single_space = 123")).\
+            scalar()
+        self.assertAlmostEqual(lat, 52.5)
+
+
+    def test_no_columns_missing(self):
+        """Does nothing if no columns are missing"""
+        with self.record_statements() as statements:
+            add_missing_columns(self.connection)
+        self.assertFalse([statement for statement in statements
+                          if statement.startswith("ALTER TABLE")])
+
+
+class TestAddMissingIndexes(TestCaseWithReconfiguredSession):
+    """Test add_missing_indexes"""
+
+    def test_missing_partial_index_added_with_column(self):
+        """Missing column and partial index on it are both added"""
+        self.connection.execute(
+            text("ALTER TABLE osm_fhrs_mapping DROP COLUMN distant"))
+        add_missing_columns(self.connection)
+        add_missing_indexes(self.connection)
+        index_names = [index["name"] for index in inspect(self.connection).\
+                       get_indexes("osm_fhrs_mapping")]
+        self.assertIn("idx_osm_fhrs_mapping_distant", index_names)
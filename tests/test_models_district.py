@@ -0,0 +1,32 @@
+"""Tests for district relationships of fhodot.models"""
+
+from sqlalchemy.exc import InvalidRequestError
+
+from fhodot.database import Session
+from fhodot.models.district import LocalAuthorityDistrict
+from fhodot.models.osm import OSMObject
+from tests import TestCaseWithReconfiguredSession
+
+
+class TestDistrictRelationships(TestCaseWithReconfiguredSession):
+    """Test that district relationships aren't lazy loaded per object"""
+
+    def setUp(self):
+        super().setUp()
+        Session.add(LocalAuthorityDistrict(
+            code="T00000001", name="District 1",
+            boundary="MULTIPOLYGON(((0 0,1 0,1 1,0 1,0 0)))"))
+        Session.add(OSMObject(osm_id_single_space=1,
+                              location="POINT(0.5 0.5)"))
+        Session.commit()
+        Session.remove()
+
+
+    # inherits tearDown
+
+
+    def test_lazy_load_raises(self):
+        """Accessing district without loading it raises an error"""
+        osm = Session.query(OSMObject).first()
+        with self.assertRaises(InvalidRequestError):
+            osm.district # pylint: disable=pointless-statement
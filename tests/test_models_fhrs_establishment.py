@@ -142,6 +142,15 @@ class TestFHRSEstablishmentValidation(TestCaseWithReconfiguredSession):
             self.assertIsNone(self.est.postcode)
 
 
+    def test_postcode_validation_invalid_repeated(self):
+        """Repeated invalid postcode should be logged each time"""
+
+        for _ in range(2):
+            with self.assertLogs(level="WARNING"):
+                self.est.postcode = "Devon"
+            self.assertIsNone(self.est.postcode)
+
+
 class TestFHRSEstablishmentLatLon(TestCaseWithReconfiguredSession):
     """Test latitude/longitude column properties"""
 
@@ -248,12 +257,24 @@ class TestFHRSEstablishmentNumMatches(TestCaseWithReconfiguredSession):
 
 
     def test_expressions(self):
-        """Should raise NotImplementedError"""
+        """SQL expressions count OSM matches with same/different postcode"""
 
-        with self.assertRaises(NotImplementedError):
-            Session.query(FHRSEstablishment).\
-                filter(FHRSEstablishment.num_matches_same_postcodes == 1)
-
-        with self.assertRaises(NotImplementedError):
+        self.est.postcode = "AB12 3XY"
+        Session.add(self.est)
+        for osm_id, postcode in ((1, "AB12 3XY"), (2, "AB12 3XY"),
+                                 (3, "XY12 3AB"), (4, None)):
+            osm = OSMObject(osm_id_single_space=osm_id,
+                            addr_postcode=postcode)
+            Session.add_all([osm, OSMFHRSMapping(osm_object=osm,
+                                                 fhrs_id=self.est.fhrs_id)])
+
+        self.assertEqual(
+            Session.query(FHRSEstablishment.num_matches_same_postcodes).\
+                scalar(),
+            2)
+        self.assertEqual(
             Session.query(FHRSEstablishment).\
-                filter(FHRSEstablishment.num_matches_different_postcodes == 1)
+                filter(FHRSEstablishment.num_matches_different_postcodes ==
+                       2).\
+                count(),
+            1)
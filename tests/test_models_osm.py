@@ -1,5 +1,9 @@
 """Tests for fhodot.models.osm.OSMObject"""
 
+from os.path import abspath, dirname, join
+from re import DOTALL, findall
+from unittest import TestCase
+
 from fhodot.database import Session
 from fhodot.models.fhrs import FHRSAuthority, FHRSEstablishment
 from fhodot.models.mapping import OSMFHRSMapping
@@ -67,16 +71,62 @@ class TestOSMObjectNumMatches(TestCaseWithReconfiguredSession):
 
 
     def test_expressions(self):
-        """Should raise NotImplementedError"""
+        """SQL expressions count FHRS matches with same/different postcode
 
-        with self.assertRaises(NotImplementedError):
-            Session.query(OSMObject).\
-                filter(OSMObject.num_matches_same_postcodes == 1)
+        num_mismatched_fhrs_ids should still raise NotImplementedError
+        """
 
-        with self.assertRaises(NotImplementedError):
+        auth = FHRSAuthority(
+            code=321,
+            name="Authority Name",
+            region_name="Authority Region",
+            xml_url="http://ratings.food.gov.uk/OpenDataFiles/FHRS760en-GB.xml")
+        self.osm.addr_postcode = "AB12 3XY"
+        Session.add_all([auth, self.osm])
+        # FHRS ID 4 doesn't match an establishment so isn't counted
+        for fhrs_id, postcode in ((1, "AB12 3XY"), (2, "XY12 3AB"),
+                                  (3, "XY12 3AB"), (4, None)):
+            if postcode:
+                Session.add(FHRSEstablishment(
+                    fhrs_id=fhrs_id, name="Establishment Name",
+                    postcode=postcode, authority=auth))
+            Session.add(OSMFHRSMapping(osm_object=self.osm, fhrs_id=fhrs_id))
+
+        self.assertEqual(
+            Session.query(OSMObject.num_matches_same_postcodes).scalar(), 1)
+        self.assertEqual(
             Session.query(OSMObject).\
-                filter(OSMObject.num_matches_different_postcodes == 1)
+                filter(OSMObject.num_matches_different_postcodes == 2).\
+                count(),
+            1)
 
         with self.assertRaises(NotImplementedError):
             Session.query(OSMObject).\
                 filter(OSMObject.num_mismatched_fhrs_ids == 1)
+
+
+
+class TestOSMObjectGeneratedColumns(TestCase):
+    """Test generated columns match those added by post_import.sql"""
+
+    def test_generated_columns_match_post_import_sql(self):
+        """Each generated column has the same expression in the SQL"""
+
+        sql_path = join(dirname(dirname(abspath(__file__))),
+                        "import", "osm", "post_import.sql")
+        with open(sql_path) as sql_file:
+            sql = sql_file.read()
+        sql_expressions = {
+            name: " ".join(expression.split()) for name, expression
+            in findall(r"ADD COLUMN (\w+) [^\n]*\s+" +
+                       r"GENERATED ALWAYS AS \((.*?)\) STORED;",
+                       sql, DOTALL)}
+
+        computed_columns = [column for column in OSMObject.__table__.columns
+                            if column.computed is not None]
+        self.assertTrue(computed_columns)
+        for column in computed_columns:
+            with self.subTest(column=column.name):
+                self.assertEqual(
+                    sql_expressions.get(column.name),
+                    " ".join(str(column.computed.sqltext).split()))
@@ -0,0 +1,93 @@
+"""Tests for fhodot.stats"""
+
+from datetime import date
+
+from fhodot.database import Session
+from fhodot.models import (FHRSAuthority, FHRSAuthorityStatistic,
+                           FHRSEstablishment, LocalAuthorityDistrict,
+                           OSMFHRSMapping, OSMLocalAuthorityDistrictStatistic,
+                           OSMObject)
+from fhodot.stats import replace_current_stats_in_session
+from tests import TestCaseWithReconfiguredSession
+
+
+class TestReplaceCurrentStats(TestCaseWithReconfiguredSession):
+    """Test calculating today's statistics"""
+
+    def setUp(self):
+        super().setUp()
+
+        Session.add(LocalAuthorityDistrict(
+            code="T00000001", name="District",
+            boundary="MULTIPOLYGON(((0 0,1 0,1 1,0 1,0 0)))"))
+        # authorities with not null columns set, the second without any
+        # establishments
+        for code in (321, 322):
+            Session.add(FHRSAuthority(
+                code=code, name=f"Authority {code}",
+                region_name="Authority Region",
+                xml_url="http://ratings.food.gov.uk/OpenDataFiles/" +
+                        f"FHRS{code}en-GB.xml"))
+
+        # (FHRS ID, FHRS postcode, has location, OSM postcodes)
+        for fhrs_id, postcode, has_location, osm_postcodes in (
+                (1, "AB12 3XY", True, ["AB12 3XY"]),
+                (2, "AB12 3XY", True, ["AB12 3XY", "XY12 3AB"]),
+                (3, "AB12 3XY", True, []),
+                (4, "AB12 3XY", False, [])):
+            establishment = FHRSEstablishment(
+                fhrs_id=fhrs_id, name="Establishment Name",
+                postcode=postcode, authority_code=321)
+            if has_location:
+                establishment.set_location(lat="0.5", lon="0.5")
+            Session.add(establishment)
+            for osm_postcode in osm_postcodes:
+                self.add_osm_object(osm_postcode, fhrs_id)
+        self.add_osm_object("AB12 3XY", None) # unmatched
+        self.add_osm_object("AB12 3XY", 5) # FHRS ID doesn't exist
+        Session.commit()
+
+
+    # inherits tearDown
+
+
+    def add_osm_object(self, postcode, fhrs_id):
+        """Add an OSM object in the district, mapped to FHRS ID if any"""
+        osm_object = OSMObject(
+            osm_id_single_space=Session.query(OSMObject).count() + 1,
+            addr_postcode=postcode, location="POINT(0.5 0.5)")
+        Session.add(osm_object)
+        if fhrs_id:
+            Session.add(OSMFHRSMapping(osm_object=osm_object,
+                                       fhrs_id=fhrs_id))
+
+
+    def test_fhrs(self):
+        """Counts for each status and authority, including zeros"""
+        replace_current_stats_in_session()
+        stats = {(stat.authority_code, stat.statistic): stat.value
+                 for stat in Session.query(FHRSAuthorityStatistic).\
+                     filter(FHRSAuthorityStatistic.date == date.today())}
+        self.assertEqual(stats, {
+            (321, "matched_same_postcodes"): 1,
+            (321, "matched_different_postcodes"): 1,
+            (321, "unmatched_with_location"): 1,
+            (321, "unmatched_without_location"): 1,
+            (322, "matched_same_postcodes"): 0,
+            (322, "matched_different_postcodes"): 0,
+            (322, "unmatched_with_location"): 0,
+            (322, "unmatched_without_location"): 0})
+
+
+    def test_osm(self):
+        """Counts for each status in district"""
+        replace_current_stats_in_session()
+        stats = {stat.statistic: stat.value
+                 for stat in Session.query(
+                     OSMLocalAuthorityDistrictStatistic).\
+                     filter(OSMLocalAuthorityDistrictStatistic.date ==
+                            date.today())}
+        self.assertEqual(stats, {"matched_same_postcodes": 2,
+                                 "matched_different_postcodes": 1,
+                                 "mismatched": 1,
+                                 "unmatched": 1})